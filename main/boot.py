@@ -0,0 +1,5 @@
+# roll back an interrupted or failed firmware update before anything
+# else is imported
+import ota
+
+ota.check_boot()
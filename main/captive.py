@@ -0,0 +1,38 @@
+import logging
+from phew import server
+
+from settings import AP_DOMAIN
+
+# phones and laptops joining the access point check for a captive portal
+# by fetching a well known url and expecting a fixed answer. anything else
+# (here a redirect) makes them open the portal page. the probes arrive in
+# bursts, so the replies are built once and written without any template
+# rendering or file access
+PORTAL_URL = f"http://{AP_DOMAIN}/settings/wifi"
+
+PROBE_PATHS = (
+    # android and chrome os
+    "/generate_204",
+    "/gen_204",
+    # apple
+    "/hotspot-detect.html",
+    "/library/test/success.html",
+    # windows
+    "/connecttest.txt",
+    "/ncsi.txt",
+    "/redirect",
+    # firefox
+    "/canonical.html",
+    "/success.txt",
+)
+
+_redirect = server.PrebuiltResponse(302, {"Location": PORTAL_URL, "Cache-Control": "no-store"})
+
+
+def probe(request):
+    return _redirect
+
+
+for _path in PROBE_PATHS:
+    server.add_route(_path, probe, methods=["GET", "HEAD"])
+logging.debug('captive portal probes redirect to %s', PORTAL_URL)
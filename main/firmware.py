@@ -1,12 +1,39 @@
+import json
 import logging
+import os
+import uasyncio as asyncio
 from phew import server
 from phew.template import render_template
 
+import ota
+from phew import is_connected_to_wifi
 from settings import SETTINGS_TEMPLATE_PATH, APP_NAME
 
+# the pull mode update client is configured by config/ota.json, e.g.
+#   {"url": "http://192.168.1.10:8000/version.json", "interval": 3600}
+# the url returns the latest release as
+#   {"version": "1.1", "package": "update-1.1.tar", "size": 12345,
+#    "sha256": "...", "deltas": {"1.0": {"package": ..., "size": ..., "sha256": ...}}}
+# where package urls are relative to the version url. packages are
+# downloaded with range requests into DOWNLOAD_FILE so an interrupted
+# download carries on from the bytes already on flash
+OTA_CONFIG_FILE = "config/ota.json"
+DOWNLOAD_FILE = ota.OTA_DIR + "/download.tar"
+DOWNLOAD_RECORD = ota.OTA_DIR + "/download.json"
+DOWNLOAD_BUFFER_SIZE = 1024
+# the partial download is flushed to flash at least this often
+DOWNLOAD_FLUSH_BYTES = 16 * 1024
+# seconds to connect, to get the headers or between reads of the body
+# before the update server is given up on
+HTTP_TIMEOUT = 20
+# a failed check or an interrupted download is retried after this many
+# seconds, doubling on each failure up to the polling interval
+RESUME_RETRY_MIN = 10
+# seconds between looks at the wi-fi link while it is down
+LINK_POLL_SECONDS = 5
+
 
 @server.route("/settings/firmware", methods=["GET"])
-@server.route("/settings/firmware/", methods=["GET"])
 async def firmware_home(request):
     logging.debug("firmware_home")
     args = get_args(page='Firmware Settings')
@@ -20,8 +47,250 @@ async def firmware_configure(request):
     return await render_template(f"{SETTINGS_TEMPLATE_PATH}/firmware_configure.html", args=args)
 
 
+# hashes of the installed files, tools/ota_package.py --base fetches this
+# to build a delta update holding only the files that have changed.
+# ?rescan=1 hashes the files on flash rather than trusting the manifest
+@server.route("/settings/firmware/manifest", methods=["GET"])
+def firmware_manifest(request):
+    logging.debug("firmware_manifest")
+    manifest = ota.device_manifest(rescan='rescan' in request.query)
+    return json.dumps(manifest), 200, "application/json"
+
+
+# the uploaded tar is extracted and verified by ota.TarInstaller while it
+# is being received, by the time the handler runs it only has to swap the
+# staged files in and restart
+@server.route("/settings/firmware/upload", methods=["POST"], upload=ota.TarInstaller)
+async def firmware_upload(request):
+    logging.debug("firmware_upload")
+    installer = request.form.get('firmware')
+    if not isinstance(installer, ota.TarInstaller):
+        message = 'No update file uploaded'
+    elif installer.error is not None:
+        message = 'Update failed: ' + installer.error
+    else:
+        try:
+            installer.install()
+            # the static files may have changed under their manifests
+            server.clear_manifests()
+            message = f'Installed version {installer.version}, restarting'
+            asyncio.create_task(restart())
+        except (OSError, ValueError) as e:
+            logging.error('firmware_upload install failed %s', e)
+            message = f'Update failed: {e}'
+    args = get_args(page='Configure Firmware Settings')
+    args['message'] = message
+    return await render_template(f"{SETTINGS_TEMPLATE_PATH}/firmware_configure.html", args=args)
+
+
+def load_ota_config():
+    try:
+        with open(OTA_CONFIG_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _split_url(url):
+    if not url.startswith("http://"):
+        raise ValueError("only http update servers are supported: " + url)
+    host, _, path = url[7:].partition("/")
+    host, _, port = host.partition(":")
+    return host, int(port) if port else 80, "/" + path
+
+
+def _resolve_url(base, url):
+    if url.startswith("http://"):
+        return url
+    return base.rpartition("/")[0] + "/" + url
+
+
+# sends a GET and reads the response headers, the caller reads the body
+# from the returned reader and must close the writer
+async def _http_get(url, headers=()):
+    host, port, path = _split_url(url)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), HTTP_TIMEOUT)
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n"
+    for name, value in headers:
+        request += f"{name}: {value}\r\n"
+    try:
+        writer.write((request + "\r\n").encode())
+        await asyncio.wait_for(writer.drain(), HTTP_TIMEOUT)
+        status, response_headers = await asyncio.wait_for(_read_head(reader, url), HTTP_TIMEOUT)
+    except BaseException:
+        writer.close()
+        await writer.wait_closed()
+        raise
+    return status, response_headers, reader, writer
+
+
+async def _read_head(reader, url):
+    status_line = await reader.readline()
+    try:
+        status = int(status_line.split()[1])
+    except (IndexError, ValueError):
+        raise OSError("bad response from " + url)
+    response_headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        response_headers[name.strip().lower()] = value.strip()
+    return status, response_headers
+
+
+async def fetch_json(url):
+    status, headers, reader, writer = await _http_get(url)
+    try:
+        if status != 200:
+            raise OSError(f"{url} returned {status}")
+        if "content-length" in headers:
+            body = await asyncio.wait_for(reader.readexactly(int(headers["content-length"])), HTTP_TIMEOUT)
+        else:
+            body = await asyncio.wait_for(reader.read(-1), HTTP_TIMEOUT)
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    return json.loads(body.decode())
+
+
+def _file_size(path):
+    try:
+        return os.stat(path)[6]
+    except OSError:
+        return 0
+
+
+# downloads url into path, carrying on from whatever is already there
+async def download(url, path, size=None):
+    offset = _file_size(path)
+    if size is not None and offset >= size:
+        return
+    headers = [("Range", f"bytes={offset}-")] if offset else []
+    status, response_headers, reader, writer = await _http_get(url, headers)
+    try:
+        if status == 206 and response_headers.get("content-range", "").startswith(f"bytes {offset}-"):
+            mode = "ab"
+            logging.info("> ota resuming download at %d", offset)
+        elif status == 200:
+            # the server ignored the range, start again
+            offset = 0
+            mode = "wb"
+        elif status == 416 and offset:
+            return
+        else:
+            raise OSError(f"{url} returned {status}")
+
+        buffer = bytearray(DOWNLOAD_BUFFER_SIZE)
+        view = memoryview(buffer)
+        flushed = offset
+        with open(path, mode) as f:
+            while True:
+                # a stalled link never ends the body, give up on it
+                count = await asyncio.wait_for(reader.readinto(buffer), HTTP_TIMEOUT)
+                if not count:
+                    break
+                f.write(view[:count])
+                offset += count
+                if offset - flushed >= DOWNLOAD_FLUSH_BYTES:
+                    f.flush()
+                    flushed = offset
+    finally:
+        writer.close()
+        await writer.wait_closed()
+    if size is not None and offset != size:
+        raise OSError(f"download stopped at {offset} of {size} bytes")
+
+
+def _discard_download():
+    for path in (DOWNLOAD_FILE, DOWNLOAD_RECORD):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# checks the update server and downloads and installs a newer release,
+# returns True if an update was installed
+async def check_for_update(url):
+    release = await fetch_json(url)
+    installed = ota.installed_version()
+    if release["version"] == installed:
+        return False
+
+    # a delta from the installed version is preferred to the full package
+    package = release.get("deltas", {}).get(installed, release)
+    record = {"version": release["version"],
+              "url": _resolve_url(url, package["package"]),
+              "size": package.get("size"),
+              "sha256": package.get("sha256")}
+    try:
+        with open(DOWNLOAD_RECORD) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = None
+    if previous != record:
+        # a different package, any partial download is no use
+        _discard_download()
+        ota.makedirs(ota.OTA_DIR)
+        with open(DOWNLOAD_RECORD, "w") as f:
+            json.dump(record, f)
+
+    logging.info("> ota downloading version %s from %s", record["version"], record["url"])
+    await download(record["url"], DOWNLOAD_FILE, record["size"])
+
+    installer = ota.install_from_file(DOWNLOAD_FILE, record["sha256"])
+    _discard_download()
+    if installer.error is not None:
+        raise ValueError(installer.error)
+    installer.install()
+    server.clear_manifests()
+    return True
+
+
+# polls the update server configured in config/ota.json
+async def run_ota_client():
+    config = load_ota_config()
+    if config is None:
+        logging.debug("no %s, ota client disabled", OTA_CONFIG_FILE)
+        return
+    interval = config.get("interval", 3600)
+    retry = RESUME_RETRY_MIN
+    while True:
+        if not is_connected_to_wifi():
+            # the supervisor may still be connecting, check as soon as it has
+            await asyncio.sleep(LINK_POLL_SECONDS)
+            continue
+        failed = False
+        try:
+            if await check_for_update(config["url"]):
+                await restart()
+        except Exception as e:
+            logging.error("ota update check failed: %s", e)
+            failed = True
+        if failed or _file_size(DOWNLOAD_FILE):
+            # try again (resuming any partial download) soon, backing off
+            # while it keeps failing
+            delay = min(retry, interval)
+            retry = min(retry * 2, interval)
+        else:
+            delay = interval
+            retry = RESUME_RETRY_MIN
+        await asyncio.sleep(delay)
+
+
+async def restart(delay=2):
+    import machine
+    await asyncio.sleep(delay)
+    logging.flush()
+    machine.reset()
+
+
 def get_args(page, form=None):
     args = {'app_name': APP_NAME,
             'page': page,
+            'version': ota.installed_version(),
+            'message': None,
             'form': form}
     return args
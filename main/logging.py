@@ -1,6 +1,9 @@
-import machine, os, gc
+import machine, os, gc, time
+import uasyncio
 
-log_file = "log.txt"
+# the log is kept as _log_segments files, log.0 (the newest, being
+# appended to) up to log.<n-1> (the oldest)
+log_file = "log"
 
 LOG_INFO = 0b00001
 LOG_WARNING = 0b00010
@@ -11,15 +14,45 @@ LOG_ALL = LOG_INFO | LOG_WARNING | LOG_ERROR | LOG_DEBUG | LOG_EXCEPTION
 
 _logging_types = LOG_INFO | LOG_WARNING | LOG_ERROR | LOG_EXCEPTION
 
-# the log file will be truncated if it exceeds _log_truncate_at bytes in
-# size. the defaults values are designed to limit the log to at most
-# three blocks on the Pico
-_log_truncate_at = 11 * 1024
-_log_truncate_to =  8 * 1024
+# once log.0 reaches _log_segment_size bytes the segments are rotated,
+# the oldest is deleted and the rest renamed up by one, so rotation
+# costs a fixed number of renames however big the log is. the defaults
+# limit the log to roughly three blocks on the Pico
+_log_segment_size = 4 * 1024
+_log_segments = 3
+# bytes in log.0, read from the filesystem on the first write
+_log_segment_bytes = None
+
+# records are kept in an in-ram ring buffer and appended to the log file
+# in batches by the flusher task, either once _flush_threshold records
+# are waiting or every _flush_interval_ms. when the ring is full new
+# records are dropped and counted rather than blocking the caller. until
+# run_flusher() is started every record is written straight through
+_buffer_size = 32
+_flush_threshold = 16
+_flush_interval_ms = 2000
+
+_ring = [None] * _buffer_size
+_ring_head = 0
+_ring_count = 0
+_flusher_running = False
+_flush_event = None
+dropped = 0
+
+# the formatted timestamp only changes once a second so it is cached
+# rather than rebuilt (and the rtc queried) for every record
+_rtc = machine.RTC()
+_datetime_second = None
+_datetime_text = None
 
 def datetime_string():
-  dt = machine.RTC().datetime()
-  return "{0:04d}-{1:02d}-{2:02d} {4:02d}:{5:02d}:{6:02d}".format(*dt)
+  global _datetime_second, _datetime_text
+  second = time.time()
+  if second != _datetime_second:
+    dt = _rtc.datetime()
+    _datetime_text = "{0:04d}-{1:02d}-{2:02d} {4:02d}:{5:02d}:{6:02d}".format(*dt)
+    _datetime_second = second
+  return _datetime_text
 
 def file_size(file):
   try:
@@ -27,11 +60,28 @@ def file_size(file):
   except OSError:
     return None
 
-def set_truncate_thresholds(truncate_at, truncate_to):
-  global _log_truncate_at
-  global _log_truncate_to
-  _log_truncate_at = truncate_at
-  _log_truncate_to = truncate_to
+def set_rotation(segment_size, segments):
+  global _log_segment_size
+  global _log_segments
+  _log_segment_size = segment_size
+  _log_segments = segments
+
+def set_buffering(buffer_size, flush_threshold, flush_interval_ms):
+  global _buffer_size, _flush_threshold, _flush_interval_ms
+  global _ring, _ring_head, _ring_count
+  flush()
+  _buffer_size = buffer_size
+  _flush_threshold = flush_threshold
+  _flush_interval_ms = flush_interval_ms
+  _ring = [None] * _buffer_size
+  _ring_head = 0
+  _ring_count = 0
+
+# lets hot paths skip building log arguments entirely, e.g.
+#   if logging.is_enabled(logging.LOG_DEBUG):
+#     logging.debug("state %s", expensive_state())
+def is_enabled(level):
+  return _logging_types & level != 0
 
 def enable_logging_types(types):
   global _logging_types
@@ -41,71 +91,138 @@ def disable_logging_types(types):
   global _logging_types
   _logging_types = _logging_types & ~types
 
-# truncates the log file down to a target size while maintaining
-# clean line breaks
-def truncate(file, target_size):
-  # get the current size of the log file
-  size = file_size(file)
+def segment_file(index):
+  return "{}.{}".format(log_file, index)
 
-  # calculate how many bytes we're aiming to discard
-  discard = size - target_size
-  if discard <= 0:
-    return
-
-  with open(file, "rb") as infile:
-    with open(file + ".tmp", "wb") as outfile:
-      # skip a bunch of the input file until we've discarded
-      # at least enough
-      while discard > 0:
-        chunk = infile.read(1024)
-        discard -= len(chunk)
-
-      # try to find a line break nearby to split first chunk on
-      break_position = max(
-        chunk.find (b"\n", -discard), # search forward
-        chunk.rfind(b"\n", -discard) # search backwards
-      )
-      if break_position != -1: # if we found a line break..
-        outfile.write(chunk[break_position + 1:])
-
-      # now copy the rest of the file
+# drops the oldest segment and shifts the others up one, leaving log.0
+# free for new records
+def rotate():
+  global _log_segment_bytes
+  try:
+    os.remove(segment_file(_log_segments - 1))
+  except OSError:
+    pass
+  for index in range(_log_segments - 2, -1, -1):
+    try:
+      os.rename(segment_file(index), segment_file(index + 1))
+    except OSError:
+      pass
+  _log_segment_bytes = 0
+
+# yields the whole log oldest record first, a chunk at a time
+def read_log(chunk_size=512):
+  for index in range(_log_segments - 1, -1, -1):
+    try:
+      f = open(segment_file(index), "rb")
+    except OSError:
+      continue
+    with f:
       while True:
-        chunk = infile.read(1024)
-        if not chunk: 
+        chunk = f.read(chunk_size)
+        if not chunk:
           break
-        outfile.write(chunk)
-
-  # delete the old file and replace with the new
-  os.remove(file)
-  os.rename(file + ".tmp", file)
-
+        yield chunk
+
+def _write_entries(entries):
+  global _log_segment_bytes
+  current = segment_file(0)
+  if _log_segment_bytes is None:
+    _log_segment_bytes = file_size(current) or 0
+
+  with open(current, "a") as logfile:
+    for entry in entries:
+      logfile.write(entry)
+      logfile.write("\n")
+      _log_segment_bytes += len(entry) + 1
+
+  if _log_segment_size and _log_segment_bytes >= _log_segment_size:
+    rotate()
+
+# takes everything out of the ring buffer, oldest first
+def _drain():
+  global _ring_head, _ring_count, dropped
+  entries = []
+  while _ring_count:
+    entries.append(_ring[_ring_head])
+    _ring[_ring_head] = None
+    _ring_head = (_ring_head + 1) % _buffer_size
+    _ring_count -= 1
+  if dropped:
+    entries.append("{0} [{1:8} /{2:>4}kB] {3} log records dropped".format(
+      datetime_string(), "warning", (gc.mem_free() + 512) >> 10, dropped))
+    dropped = 0
+  return entries
+
+# writes any buffered records to the log file now
+def flush():
+  entries = _drain()
+  if entries:
+    _write_entries(entries)
+
+# background task that writes the buffered records to flash in batches
+async def run_flusher():
+  global _flusher_running, _flush_event
+  _flush_event = uasyncio.Event()
+  _flusher_running = True
+  try:
+    while True:
+      try:
+        await uasyncio.wait_for_ms(_flush_event.wait(), _flush_interval_ms)
+      except uasyncio.TimeoutError:
+        pass
+      _flush_event.clear()
+      flush()
+  finally:
+    _flusher_running = False
+    flush()
 
 def log(level, text):
+  global _ring_count, dropped
   datetime = datetime_string()
-  log_entry = "{0} [{1:8} /{2:>4}kB] {3}".format(datetime, level, round(gc.mem_free() / 1024), text)
+  log_entry = "{0} [{1:8} /{2:>4}kB] {3}".format(datetime, level, (gc.mem_free() + 512) >> 10, text)
   print(log_entry)
-  with open(log_file, "a") as logfile:
-    logfile.write(log_entry + '\n')
 
-  if _log_truncate_at and file_size(log_file) > _log_truncate_at:
-    truncate(log_file, _log_truncate_to)
+  if not _flusher_running:
+    _write_entries((log_entry,))
+    return
+
+  if _ring_count == _buffer_size:
+    dropped += 1
+    return
+  _ring[(_ring_head + _ring_count) % _buffer_size] = log_entry
+  _ring_count += 1
+  if _ring_count >= _flush_threshold:
+    _flush_event.set()
+
+# builds the record text, either %-style when the first item is a format
+# string with arguments or by joining the items with spaces. only called
+# once the level has been checked so disabled levels cost nothing
+def _message(items):
+  if len(items) > 1 and isinstance(items[0], str) and "%" in items[0]:
+    try:
+      return items[0] % items[1:]
+    except (TypeError, ValueError):
+      pass
+  if len(items) == 1 and isinstance(items[0], str):
+    return items[0]
+  return " ".join(map(str, items))
 
 def info(*items):
   if _logging_types & LOG_INFO:
-    log("info", " ".join(map(str, items)))
+    log("info", _message(items))
 
 def warn(*items):
   if _logging_types & LOG_WARNING:
-    log("warning", " ".join(map(str, items)))
+    log("warning", _message(items))
 
 def error(*items):
   if _logging_types & LOG_ERROR:
-    log("error", " ".join(map(str, items)))
+    log("error", _message(items))
 
 def debug(*items):
   if _logging_types & LOG_DEBUG:
-    log("debug", " ".join(map(str, items)))
+    log("debug", _message(items))
 
 def exception(*items):
   if _logging_types & LOG_EXCEPTION:
-    log("exception", " ".join(map(str, items)))
\ No newline at end of file
+    log("exception", _message(items))
@@ -6,7 +6,10 @@ import uasyncio as asyncio
 from phew import server
 from phew.template import render_template
 import settings
+import captive
+import wifiapi
 import firmware
+import ota
 import wifimanager
 from tarfile import TarFile
 
@@ -25,17 +28,19 @@ def exists(path):
 
 def untar(tarfilename, target='/untar', overwrite=False, verbose=False, chunksize=4096):
     size_b, free_b = print_memory('before')
-    with open(tarfilename) as tar:
+    buffer = bytearray(chunksize)
+    view = memoryview(buffer)
+    with open(tarfilename, 'rb') as tar:
         if not exists(target):
             print(target)
             os.mkdir(target)
         for info in TarFile(fileobj=tar):
             print(info.name)
+            name = target + '/' + info.name.rstrip("/")
             if info.type == "dir":
                 if verbose:
                     print("D %s" % info.name)
 
-                name = target + '/' + info.name.rstrip("/")
                 if not exists(name):
                     print(name)
                     os.mkdir(name)
@@ -43,13 +48,13 @@ def untar(tarfilename, target='/untar', overwrite=False, verbose=False, chunksiz
                 if verbose:
                     print("F %s" % info.name)
 
-                if overwrite or not exists(info.name):
-                    with open(info.name, "wb") as fp:
+                if overwrite or not exists(name):
+                    with open(name, "wb") as fp:
                         while True:
-                            chunk = info.subf.read(chunksize)
-                            if not chunk:
+                            count = info.subf.readinto(buffer)
+                            if not count:
                                break
-                            fp.write(chunk)
+                            fp.write(view[:count])
             elif verbose:
                 print("? %s" % info.name)
     size_a, free_a = print_memory('after')
@@ -64,8 +69,13 @@ async def run_app():
     logging.debug('starting app')
     port = 80
     await asyncio.gather(
-        wifimanager.wifi_manager.setup_connection(),
+        logging.run_flusher(),
+        ota.confirm_after(),
+        firmware.run_ota_client(),
+        wifimanager.wifi_manager.run_supervisor(),
+        wifimanager.wifi_manager.config.run_flusher(),
         wifimanager.wifi_manager.run_wap_loop(),
+        wifimanager.wifi_manager.run_scan_loop(),
         start_server(port=port)
     )
     logging.debug('app finished')
@@ -0,0 +1,508 @@
+import binascii
+import hashlib
+import json
+import os
+
+import logging
+
+# an update is a tar holding the new files and an ota_manifest.json that
+# gives the sha256 of each one. the tar is extracted into STAGING_DIR as
+# it is received and each file is hashed on the way through, nothing is
+# buffered in ram or written twice. once everything has been verified the
+# staged files are renamed over the active ones, the replaced files are
+# kept in BACKUP_DIR and the swap is journalled in STATE_FILE so that an
+# interrupted swap, or new code that never confirms a good boot, is
+# rolled back by check_boot()
+OTA_DIR = "ota"
+STAGING_DIR = OTA_DIR + "/staging"
+BACKUP_DIR = OTA_DIR + "/backup"
+STATE_FILE = OTA_DIR + "/state.json"
+MANIFEST_FILE = "ota_manifest.json"
+
+# a delta update's manifest also names the "base" version it was built
+# against and lists the paths to "delete". it only carries the files that
+# changed, the installed manifest is merged with it so that it always
+# describes the whole tree
+
+# device local state that is never part of an update or the manifest
+EXCLUDE = (OTA_DIR, "tmp", "config")
+# the log segments (log.0 up to however many logging.set_rotation() keeps)
+# and log.txt, the single log file of older versions, all share a prefix
+LOG_PREFIX = logging.log_file + "."
+
+# how long new code has to run before the update is confirmed
+TRIAL_SECONDS = 60
+# new code that fails once the app is running (a task raising out of
+# run_app or the loop hanging) never gets to a second boot by itself, so
+# confirm_after() runs the trial under a watchdog that only the running
+# app feeds. the rp2 limit is a little over 8 seconds
+TRIAL_WATCHDOG_MS = 8000
+
+_watchdog = None
+
+BLOCK_SIZE = 512
+
+
+def exists(path):
+    try:
+        os.stat(path)
+    except OSError:
+        return False
+    return True
+
+
+def is_dir(path):
+    try:
+        return (os.stat(path)[0] & 0x4000) != 0
+    except OSError:
+        return False
+
+
+def makedirs(path):
+    built = ""
+    for part in path.split("/"):
+        if not part:
+            continue
+        built = built + "/" + part if built else part
+        if not is_dir(built):
+            os.mkdir(built)
+
+
+def rmtree(path):
+    if not exists(path):
+        return
+    if is_dir(path):
+        for name in os.listdir(path):
+            rmtree(path + "/" + name)
+        os.rmdir(path)
+    else:
+        os.remove(path)
+
+
+def _parent(path):
+    return path.rpartition("/")[0]
+
+
+def hex_digest(hash):
+    return binascii.hexlify(hash.digest()).decode()
+
+
+def read_manifest(path=MANIFEST_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _excluded(path):
+    if "/" not in path and path.startswith(LOG_PREFIX):
+        return True
+    for pattern in EXCLUDE:
+        if path == pattern or path.startswith(pattern + "/"):
+            return True
+    return False
+
+
+def file_digest(path, buffer):
+    hash = hashlib.sha256()
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            hash.update(view[:count])
+            feed()
+    return hex_digest(hash)
+
+
+# hashes every file in the tree, slow so only used when there is no
+# installed manifest or the caller wants to check for drift
+def scan_tree(path="", files=None, buffer=None):
+    if files is None:
+        files = {}
+        buffer = bytearray(512)
+    for name in (os.listdir(path) if path else os.listdir()):
+        full = path + "/" + name if path else name
+        if _excluded(full) or full == MANIFEST_FILE:
+            continue
+        if is_dir(full):
+            scan_tree(full, files, buffer)
+        else:
+            files[full] = file_digest(full, buffer)
+    return files
+
+
+# the manifest describing the installed tree
+def device_manifest(rescan=False):
+    manifest = read_manifest()
+    if manifest is None or rescan:
+        version = manifest.get("version", "unknown") if manifest else "unknown"
+        manifest = {"version": version, "files": scan_tree()}
+    return manifest
+
+
+def installed_version():
+    manifest = read_manifest()
+    if manifest is None:
+        return "unknown"
+    return manifest.get("version", "unknown")
+
+
+# strips "./" and rejects anything that would land outside the tree
+def _safe_path(name):
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.rstrip("/")
+    if not name or name.startswith("/") or ".." in name.split("/"):
+        raise ValueError("unsafe path in update: " + name)
+    if name == OTA_DIR or name.startswith(OTA_DIR + "/"):
+        raise ValueError("update may not write to " + OTA_DIR)
+    return name
+
+
+def _tar_string(block, start, length):
+    field = bytes(block[start:start + length])
+    end = field.find(b"\0")
+    if end != -1:
+        field = field[:end]
+    return field.decode()
+
+
+# streams a tar into STAGING_DIR, hashing each file as it is written. it
+# is an upload sink for phew.server so an uploaded update goes straight
+# from the socket to flash, and can be fed from any other source through
+# write(). errors are recorded rather than raised so the rest of the
+# upload is simply discarded
+class TarInstaller:
+    def __init__(self, request=None, name=None, filename=None, content_type=None):
+        rmtree(STAGING_DIR)
+        makedirs(STAGING_DIR)
+        self.header = bytearray(BLOCK_SIZE)
+        self.header_length = 0
+        self.remaining = 0
+        self.padding = 0
+        self.path = None
+        self.file = None
+        self.hash = None
+        self.manifest = None
+        self.manifest_data = None
+        self.digests = {}
+        self.files = []
+        self.error = None
+        self.finished = False
+
+    def write(self, data):
+        if self.error is not None or self.finished:
+            return
+        try:
+            self._write(memoryview(data))
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+            logging.error("> ota failed: %s", self.error)
+            self._close_file()
+
+    def _write(self, data):
+        offset = 0
+        length = len(data)
+        while offset < length and not self.finished:
+            if self.remaining:
+                count = min(self.remaining, length - offset)
+                chunk = data[offset:offset + count]
+                if self.file is not None:
+                    self.file.write(chunk)
+                if self.hash is not None:
+                    self.hash.update(chunk)
+                if self.manifest_data is not None:
+                    self.manifest_data.extend(chunk)
+                self.remaining -= count
+                offset += count
+                if not self.remaining:
+                    self._end_entry()
+            elif self.padding:
+                count = min(self.padding, length - offset)
+                self.padding -= count
+                offset += count
+            else:
+                count = min(BLOCK_SIZE - self.header_length, length - offset)
+                self.header[self.header_length:self.header_length + count] = data[offset:offset + count]
+                self.header_length += count
+                offset += count
+                if self.header_length == BLOCK_SIZE:
+                    self.header_length = 0
+                    self._start_entry()
+
+    def _start_entry(self):
+        header = self.header
+        if header[0] == 0: # end of archive marker
+            self.finished = True
+            return
+
+        name = _tar_string(header, 0, 100)
+        if bytes(header[257:262]) == b"ustar":
+            prefix = _tar_string(header, 345, 155)
+            if prefix:
+                name = prefix + "/" + name
+        size_field = _tar_string(header, 124, 12).strip()
+        size = int(size_field, 8) if size_field else 0
+        entry_type = header[156]
+
+        self.path = None
+        self.remaining = size
+        self.padding = -size % BLOCK_SIZE
+
+        if entry_type == ord("5"): # directory
+            makedirs(STAGING_DIR + "/" + _safe_path(name))
+        elif entry_type in (0, ord("0")): # regular file
+            self.path = _safe_path(name)
+            staged = STAGING_DIR + "/" + self.path
+            makedirs(_parent(staged))
+            self.file = open(staged, "wb")
+            if self.path == MANIFEST_FILE:
+                self.manifest_data = bytearray()
+            else:
+                self.hash = hashlib.sha256()
+            if not size:
+                self._end_entry()
+        # anything else (links, pax headers) is skipped
+
+    def _close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _end_entry(self):
+        self._close_file()
+        if self.path is None:
+            return
+        if self.manifest_data is not None:
+            self.manifest = json.loads(str(self.manifest_data, "utf-8"))
+            self.manifest_data = None
+            self._check_base()
+            # check anything that arrived before the manifest
+            for path, digest in self.digests.items():
+                self._verify(path, digest)
+        elif self.hash is not None:
+            digest = hex_digest(self.hash)
+            self.hash = None
+            self.digests[self.path] = digest
+            if self.manifest is not None:
+                self._verify(self.path, digest)
+        if self.path not in self.files:
+            self.files.append(self.path)
+        self.path = None
+
+    # a delta can only be applied on top of the version it was built from
+    def _check_base(self):
+        base = self.manifest.get("base")
+        if base is not None and base != installed_version():
+            raise ValueError("update needs version {}, installed is {}".format(base, installed_version()))
+
+    def _verify(self, path, digest):
+        expected = self.manifest["files"].get(path)
+        if expected is None:
+            raise ValueError("file not in manifest: " + path)
+        if expected != digest:
+            raise ValueError("hash mismatch: " + path)
+
+    # returns the installer itself, check error before calling install()
+    def close(self):
+        self._close_file()
+        if self.error is None:
+            if not self.finished:
+                self.error = "update archive is truncated"
+            elif self.manifest is None:
+                self.error = "update has no " + MANIFEST_FILE
+            else:
+                for path in self.manifest["files"]:
+                    if path not in self.digests:
+                        self.error = "file missing from update: " + path
+                        break
+        if self.error is not None:
+            rmtree(STAGING_DIR)
+        return self
+
+    def abort(self):
+        self._close_file()
+        rmtree(STAGING_DIR)
+
+    @property
+    def version(self):
+        return self.manifest.get("version", "unknown") if self.manifest else None
+
+    # swaps the staged files into the active tree
+    def install(self):
+        if self.error is not None:
+            raise ValueError(self.error)
+        deleted = []
+        if "base" in self.manifest:
+            deleted = self._merge_manifest()
+        swap(self.files, deleted)
+
+    # replaces the staged delta manifest with the installed one updated by
+    # the delta, returns the paths to delete
+    def _merge_manifest(self):
+        self._check_base()
+        files = device_manifest()["files"]
+        files.update(self.manifest["files"])
+        deleted = []
+        for path in self.manifest.get("delete", ()):
+            path = _safe_path(path)
+            files.pop(path, None)
+            if exists(path):
+                deleted.append(path)
+        with open(STAGING_DIR + "/" + MANIFEST_FILE, "w") as f:
+            json.dump({"version": self.version, "files": files}, f)
+        return deleted
+
+
+# runs a tar that is already on flash through the installer, checking the
+# sha256 of the whole package too if one is given. returns the installer
+def install_from_file(path, sha256=None, buffer_size=1024):
+    installer = TarInstaller()
+    package_hash = hashlib.sha256() if sha256 else None
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            if package_hash is not None:
+                package_hash.update(view[:count])
+            installer.write(view[:count])
+            feed()
+    installer.close()
+    if installer.error is None and package_hash is not None and hex_digest(package_hash) != sha256:
+        installer.error = "package hash mismatch"
+        rmtree(STAGING_DIR)
+    return installer
+
+
+def _write_state(state, files):
+    makedirs(OTA_DIR)
+    with open(STATE_FILE + ".tmp", "w") as f:
+        json.dump({"state": state, "files": files}, f)
+    os.rename(STATE_FILE + ".tmp", STATE_FILE)
+
+
+def _read_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# renames each staged file over the active one, keeping the old one in
+# BACKUP_DIR, and moves deleted files there too. the journal is written
+# first so that a swap cut short by a reset is rolled back on the next boot
+def swap(files, deleted=()):
+    rmtree(BACKUP_DIR)
+    journal = files + [path for path in deleted if path not in files]
+    _write_state("swapping", journal)
+    for path in deleted:
+        if path in files:
+            continue
+        backup = BACKUP_DIR + "/" + path
+        makedirs(_parent(backup))
+        os.rename(path, backup)
+    for path in files:
+        staged = STAGING_DIR + "/" + path
+        backup = BACKUP_DIR + "/" + path
+        if exists(path):
+            makedirs(_parent(backup))
+            os.rename(path, backup)
+        makedirs(_parent(path))
+        os.rename(staged, path)
+    _write_state("pending", journal)
+    rmtree(STAGING_DIR)
+    logging.info("> ota installed %d files, deleted %d", len(files), len(deleted))
+
+
+# puts back every file replaced, added or deleted by the last swap
+def rollback(files):
+    for path in files:
+        backup = BACKUP_DIR + "/" + path
+        if exists(backup):
+            if exists(path):
+                os.remove(path)
+            os.rename(backup, path)
+        elif not exists(STAGING_DIR + "/" + path) and exists(path):
+            # a file the update added
+            os.remove(path)
+    clear()
+    logging.warn("> ota rolled back %d files", len(files))
+
+
+def clear():
+    rmtree(STAGING_DIR)
+    rmtree(BACKUP_DIR)
+    try:
+        os.remove(STATE_FILE)
+    except OSError:
+        pass
+
+
+def _arm_watchdog():
+    global _watchdog
+    try:
+        import machine
+        _watchdog = machine.WDT(timeout=TRIAL_WATCHDOG_MS)
+    except (ImportError, AttributeError, ValueError) as e:
+        logging.warn("> ota no watchdog for the trial: %s", e)
+
+
+# keeps the trial watchdog from resetting the device, call it from any
+# long running loop
+def feed():
+    if _watchdog is not None:
+        _watchdog.feed()
+
+
+# call early on every boot (boot.py does). a swap that never finished is
+# rolled back, the first boot of new code starts its trial and a second
+# boot without confirm() (after a crash, a hang caught by the watchdog or
+# a power cycle) means the new code failed so it is rolled back
+def check_boot():
+    state = _read_state()
+    if state is None:
+        return
+    if state["state"] == "swapping":
+        rollback(state["files"])
+    elif state["state"] == "pending":
+        _write_state("trial", state["files"])
+        logging.info("> ota trial boot")
+    elif state["state"] == "trial":
+        rollback(state["files"])
+        import machine
+        machine.reset()
+
+
+# marks the running code as good and drops the backups
+def confirm():
+    state = _read_state()
+    if state is not None and state["state"] == "trial":
+        clear()
+        logging.info("> ota update confirmed")
+
+
+# confirms once the app has run for the trial. it arms the watchdog when
+# a trial is running, and as the watchdog can't be stopped once armed it
+# is fed for as long as the app keeps running
+async def confirm_after(seconds=TRIAL_SECONDS):
+    import time
+    import uasyncio as asyncio
+    state = _read_state()
+    if state is not None and state["state"] == "trial":
+        _arm_watchdog()
+    interval = TRIAL_WATCHDOG_MS // 4
+    start = time.ticks_ms()
+    while time.ticks_diff(time.ticks_ms(), start) < seconds * 1000:
+        feed()
+        await asyncio.sleep_ms(interval)
+    confirm()
+    while _watchdog is not None:
+        feed()
+        await asyncio.sleep_ms(interval)
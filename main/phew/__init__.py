@@ -49,11 +49,11 @@ def connect_to_wifi(ssid, password, timeout_seconds=30):
   start = time.ticks_ms()
   status = wlan.status()
 
-  logging.debug(f"  - {statuses[status]}")
+  logging.debug("  - %s", statuses[status])
   while not wlan.isconnected() and (time.ticks_ms() - start) < (timeout_seconds * 1000):
     new_status = wlan.status()
     if status != new_status:
-      logging.debug(f"  - {statuses[status]}")
+      logging.debug("  - %s", statuses[status])
       status = new_status
     time.sleep(0.25)
 
@@ -1,33 +1,170 @@
 import uasyncio, usocket
 import logging
 
+_HEADER_SIZE = 12
+_MAX_PACKET = 512
+_TYPE_A = 1
+_TYPE_ANY = 255
+_CLASS_IN = 1
+_TTL = b"\x00\x00\x00\x3C" # time to live 60 seconds
 
-async def _handler(socket, ip_address):
+# negative answers carry an soa record so clients cache the "no such
+# record" for the ttl instead of asking again straight away
+_SOA = (b"\xC0\x0C" # pointer to domain name at byte 12
+  b"\x00\x06\x00\x01" # type and class (SOA record / IN class)
+  + _TTL +
+  b"\x00\x16" # record length (22 bytes)
+  b"\x00\x00" # root as the primary server and the mailbox
+  b"\x00\x00\x00\x01" # serial
+  b"\x00\x00\x0E\x10\x00\x00\x02\x58\x00\x01\x51\x80" # refresh, retry, expire
+  + _TTL) # negative caching ttl
+
+# forwarded queries waiting on the upstream resolver
+_max_pending = 8
+
+
+# everything after the question is the same for every A answer so it is
+# built once per server
+def _answer(ip_address):
+  return (b"\xC0\x0C" # pointer to domain name at byte 12
+    b"\x00\x01\x00\x01" # type and class (A record / IN class)
+    + _TTL +
+    b"\x00\x04" # response length (4 bytes = 1 ipv4 address)
+    + bytes(map(int, ip_address.split(".")))) # ip address parts
+
+
+# returns the offset just past the question or 0 if the packet is not a
+# standard query with a single question that we can answer
+def _question_end(request, length):
+  # a response, not a standard query, or not exactly one question
+  if length < _HEADER_SIZE + 5 or request[2] & 0xF8 or request[4] or request[5] != 1:
+    return 0
+  position = _HEADER_SIZE
+  while position < length:
+    label = request[position]
+    if label == 0:
+      position += 5 # terminating zero, type and class
+      return position if position <= length else 0
+    if label & 0xC0: # names in a question are never compressed
+      return 0
+    position += label + 1
+  return 0
+
+
+# the queried name as lowercase dotted bytes, only needed to check the
+# pass through list
+def _query_name(request, end):
+  labels = []
+  position = _HEADER_SIZE
+  while request[position]:
+    label = request[position]
+    labels.append(bytes(request[position + 1:position + 1 + label]))
+    position += label + 1
+  return b".".join(labels).lower()
+
+
+def _allowed(name, allowed):
+  for domain in allowed:
+    if name == domain or name.endswith(b"." + domain):
+      return True
+  return False
+
+
+# fills response with the answer to the question in request[:end] and
+# returns its length. A queries get our address, anything else (AAAA,
+# HTTPS, SVCB...) gets an empty NODATA answer. both are memoryviews so
+# nothing is copied on the way
+def _respond(request, end, response, answer):
+  response[:end] = request[:end] # id, flags, counts and the question
+  response[2] = 0x80 | (request[2] & 0x01) # response, recursion desired as asked
+  response[3] = 0x80 # recursion available, no error
+  qtype = (request[end - 4] << 8) | request[end - 3]
+  qclass = (request[end - 2] << 8) | request[end - 1]
+  if qclass == _CLASS_IN and qtype in (_TYPE_A, _TYPE_ANY):
+    record, counts = answer, b"\x00\x01\x00\x00\x00\x00" # an/ns/ar count
+  else:
+    record, counts = _SOA, b"\x00\x00\x00\x01\x00\x00"
+  response[6:12] = counts
+  response[end:end + len(record)] = record
+  return end + len(record)
+
+
+def _handler(socket, ip_address, allowed, upstream):
+  # one request and one response buffer for the life of the server, the
+  # answer after the question is precomputed
+  request = bytearray(_MAX_PACKET)
+  response = bytearray(_MAX_PACKET + len(_SOA))
+  request_view = memoryview(request)
+  response_view = memoryview(response)
+  answer = _answer(ip_address)
+  receive_into = getattr(socket, "recvfrom_into", None)
+  forwarder = []
   while True:
+    yield uasyncio.core._io_queue.queue_read(socket)
+    # phones send probes in bursts, answer everything that has arrived
+    # before waiting again
+    while True:
+      try:
+        if receive_into is not None:
+          length, client = receive_into(request)
+        else: # no recvfrom_into on this port
+          data, client = socket.recvfrom(_MAX_PACKET)
+          length = len(data)
+          request_view[:length] = data
+      except OSError: # nothing left to read
+        break
+      try:
+        end = _question_end(request, length)
+        if not end:
+          continue
+        if allowed and _allowed(_query_name(request, end), allowed):
+          resolver = upstream() if upstream else None
+          if resolver:
+            _forward(forwarder, socket, request_view[:length], client, resolver)
+            continue
+        socket.sendto(response_view[:_respond(request_view, end, response_view, answer)], client)
+      except Exception as e:
+        logging.error("> dns %s", e)
+
+
+# sends a query on to the real resolver, the reply is relayed back to the
+# client by _relay
+def _forward(forwarder, socket, query, client, resolver):
+  if not forwarder:
+    upstream_socket = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
+    upstream_socket.setblocking(False)
+    forwarder.extend((upstream_socket, {}))
+    uasyncio.get_event_loop().create_task(_relay(upstream_socket, socket, forwarder[1]))
+  upstream_socket, pending = forwarder
+  if len(pending) >= _max_pending:
+    pending.clear()
+  pending[bytes(query[:2])] = client
+  upstream_socket.sendto(query, usocket.getaddrinfo(resolver, 53, 0, usocket.SOCK_DGRAM)[0][-1])
+
+
+def _relay(upstream_socket, socket, pending):
+  while True:
+    yield uasyncio.core._io_queue.queue_read(upstream_socket)
     try:
-      yield uasyncio.core._io_queue.queue_read(socket)
-      request, client = socket.recvfrom(256)
-      response = request[:2] # request id
-      response += b"\x81\x80" # response flags
-      response += request[4:6] + request[4:6] # qd/an count
-      response += b"\x00\x00\x00\x00" # ns/ar count
-      response += request[12:] # origional request body
-      response += b"\xC0\x0C" # pointer to domain name at byte 12
-      response += b"\x00\x01\x00\x01" # type and class (A record / IN class)
-      response += b"\x00\x00\x00\x3C" # time to live 60 seconds
-      response += b"\x00\x04" # response length (4 bytes = 1 ipv4 address)
-      response += bytes(map(int, ip_address.split("."))) # ip address parts
-      socket.sendto(response, client)
+      reply, _ = upstream_socket.recvfrom(_MAX_PACKET)
+      client = pending.pop(reply[:2], None)
+      if client is not None:
+        socket.sendto(reply, client)
     except Exception as e:
-      logging.error(e)
+      logging.error("> dns relay %s", e)
+
 
-def run_catchall(ip_address, port=53):
-  logging.info("> starting catch all dns server on port {}".format(port))
+# answers every A query with ip_address. names in allowed (and their
+# subdomains) are passed through to the resolver returned by upstream(),
+# when it returns one
+def run_catchall(ip_address, port=53, allowed=(), upstream=None):
+  logging.info("> starting catch all dns server on port %d", port)
 
   _socket = usocket.socket(usocket.AF_INET, usocket.SOCK_DGRAM)
   _socket.setblocking(False)
   _socket.setsockopt(usocket.SOL_SOCKET, usocket.SO_REUSEADDR, 1)
   _socket.bind(usocket.getaddrinfo(ip_address, port, 0, usocket.SOCK_DGRAM)[0][-1])
 
+  allowed = tuple(domain.lower().encode() for domain in allowed)
   loop = uasyncio.get_event_loop()
-  loop.create_task(_handler(_socket, ip_address))
\ No newline at end of file
+  loop.create_task(_handler(_socket, ip_address, allowed, upstream))
@@ -1,7 +1,11 @@
 import uasyncio, os, time
 import logging
 
-_routes = []
+# routes without parameters are looked up directly by path, routes
+# with <param> segments live in a segment trie. both map each method to
+# its route so method checks are a single dict lookup
+_static_routes = {}
+_param_routes = None
 catchall_handler = None
 loop = uasyncio.get_event_loop()
 
@@ -13,29 +17,94 @@ def file_exists(filename):
     return False
 
 
-def urldecode(text):
-  text = text.replace("+", " ")
-  result = ""
-  token_caret = 0
-  # decode any % encoded characters
-  while True:
-    start = text.find("%", token_caret)
-    if start == -1:
-      result += text[token_caret:]
+def _hex_digit(c):
+  if 48 <= c <= 57: # 0-9
+    return c - 48
+  c |= 0x20 # lower case
+  if 97 <= c <= 102: # a-f
+    return c - 87
+  return -1
+
+
+# decodes text[start:end] into result starting at length, returns the new
+# length. plain runs are copied a slice at a time between the % escapes
+def _urldecode_into(text, start, end, result, length):
+  source = memoryview(text)
+  while start < end:
+    escape = text.find(b"%", start, end)
+    run_end = end if escape == -1 else escape
+    result[length:length + run_end - start] = source[start:run_end]
+    # + is a space, but only outside escapes so %2B stays a +
+    plus = text.find(b"+", start, run_end)
+    while plus != -1:
+      result[length + plus - start] = 32
+      plus = text.find(b"+", plus + 1, run_end)
+    length += run_end - start
+    if escape == -1:
       break
-    result += text[token_caret:start]
-    code = int(text[start + 1:start + 3], 16)
-    result += chr(code)
-    token_caret = start + 3
-  return result
+    high = _hex_digit(text[escape + 1]) if escape + 1 < end else -1
+    low = _hex_digit(text[escape + 2]) if escape + 2 < end else -1
+    if high == -1 or low == -1:
+      # not a valid escape, keep the % as it is
+      result[length] = 37
+      length += 1
+      start = escape + 1
+    else:
+      result[length] = (high << 4) | low
+      length += 1
+      start = escape + 3
+  return length
+
+
+def _decode_utf8(data):
+  try:
+    return str(data, "utf-8")
+  except UnicodeError:
+    return str(bytes(b if b < 128 else 63 for b in data), "utf-8")
 
+
+# decodes a url encoded string (or bytes) in a single pass over its bytes,
+# %xx escapes are decoded as utf-8 once at the end so multi byte
+# characters survive
+def urldecode(text):
+  if isinstance(text, str):
+    text = text.encode("utf-8")
+  result = bytearray(len(text))
+  length = _urldecode_into(text, 0, len(text), result, 0)
+  return _decode_utf8(memoryview(result)[:length])
+
+
+# parses a query string or url encoded form body. a key given more than
+# once collects its values in a list, a parameter without "=" has an
+# empty value and empty parameters are skipped
 def _parse_query_string(query_string):
+  if isinstance(query_string, str):
+    query_string = query_string.encode("utf-8")
   result = {}
-  for parameter in query_string.split("&"):
-    key, value = parameter.split("=", 1)
-    key = urldecode(key)
-    value = urldecode(value)
-    result[key] = value
+  # every key and value decodes into this one buffer
+  buffer = bytearray(len(query_string))
+  view = memoryview(buffer)
+  start = 0
+  end = len(query_string)
+  while start < end:
+    stop = query_string.find(b"&", start)
+    if stop == -1:
+      stop = end
+    if stop > start:
+      equals = query_string.find(b"=", start, stop)
+      if equals == -1:
+        equals = stop
+      length = _urldecode_into(query_string, start, equals, buffer, 0)
+      key = _decode_utf8(view[:length])
+      length = _urldecode_into(query_string, equals + 1, stop, buffer, 0) if equals < stop else 0
+      value = _decode_utf8(view[:length])
+      if key not in result:
+        result[key] = value
+      elif isinstance(result[key], list):
+        result[key].append(value)
+      else:
+        result[key] = [result[key], value]
+    start = stop + 1
   return result
 
 
@@ -45,6 +114,7 @@ class Request:
     self.uri = uri
     self.protocol = protocol
     self.form = {}
+    self.uploads = []
     self.data = {}
     self.query = {}
     query_string_start = uri.find("?") if uri.find("?") != -1 else len(uri)
@@ -62,9 +132,9 @@ data: {self.data}"""
 
 
 class Response:
-  def __init__(self, body, status=200, headers={}):
+  def __init__(self, body, status=200, headers=None):
     self.status = status
-    self.headers = headers
+    self.headers = headers if headers is not None else {}
     self.body = body
 
   def add_header(self, name, value):
@@ -77,6 +147,22 @@ headers: {self.headers}
 body: {self.body}"""
 
 
+# a complete response, status line and headers included, encoded once
+# when it is created and then written as is every time it is returned.
+# for small fixed replies that are served over and over
+class PrebuiltResponse:
+  def __init__(self, status, headers=None, body=b""):
+    self.status = status
+    head = "HTTP/1.1 {} {}\r\n".format(status, status_message_map.get(status, "Unknown"))
+    if headers:
+      for key, value in headers.items():
+        head += "{}: {}\r\n".format(key, value)
+    head += "Content-Length: {}\r\n".format(len(body))
+    head = head.encode("ascii")
+    self.keep_alive = head + b"Connection: keep-alive\r\n\r\n" + body
+    self.close = head + b"Connection: close\r\n\r\n" + body
+
+
 content_type_map = {
   "html": "text/html",
   "jpg": "image/jpeg",
@@ -84,58 +170,363 @@ content_type_map = {
   "svg": "image/svg+xml",
   "json": "application/json",
   "png": "image/png",
+  "gif": "image/gif",
+  "ico": "image/x-icon",
   "css": "text/css",
   "js": "text/javascript",
   "csv": "text/csv",
+  "txt": "text/plain",
 }
 
 
+_http_days = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_http_months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+                "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+# formats seconds since the epoch as an rfc 7231 date
+def _http_date(seconds):
+  t = time.gmtime(seconds)
+  return "{}, {:02d} {} {:04d} {:02d}:{:02d}:{:02d} GMT".format(
+    _http_days[t[6]], t[2], _http_months[t[1] - 1], t[0], t[3], t[4], t[5])
+
+
+# parses a single "bytes=" range against a file of the given size and
+# returns (start, end) with end inclusive. returns None if the header
+# should be ignored and False if the range can't be satisfied
+def _parse_range(value, size):
+  if not value.startswith("bytes=") or "," in value:
+    return None
+  start, _, end = value[6:].strip().partition("-")
+  try:
+    if start:
+      start = int(start)
+      end = int(end) if end else size - 1
+    elif end: # suffix range, the last n bytes
+      start = max(size - int(end), 0)
+      end = size - 1
+    else:
+      return None
+  except ValueError:
+    return None
+  if start > end or start >= size:
+    return False
+  return start, min(end, size - 1)
+
+
+# static directories may carry a manifest written by the host side
+# tools/gzip_static.py build step, giving the size and hash of each file
+# and the size of its pre-compressed .gz sibling. files listed in it are
+# served without touching the filesystem metadata at all, so the manifest
+# must be rebuilt whenever the files change. it is read once per
+# directory and dropped by clear_manifests() when an update is installed
+MANIFEST_NAME = "manifest.json"
+_manifests = {}
+
+
+def _manifest_entry(file):
+  directory, _, name = file.rpartition("/")
+  manifest = _manifests.get(directory)
+  if manifest is None:
+    try:
+      import json
+      with open(directory + "/" + MANIFEST_NAME) as f:
+        manifest = json.load(f)
+    except (OSError, ValueError):
+      manifest = False # remember that there isn't one
+    _manifests[directory] = manifest
+  return manifest.get(name) if manifest else None
+
+
+# forget loaded manifests, call after the static content has been replaced
+def clear_manifests():
+  _manifests.clear()
+
+
 class FileResponse(Response):
-  def __init__(self, file, status=200, headers={}):
+  def __init__(self, file, status=200, headers=None):
     self.status = 404
-    self.headers = headers
+    self.headers = headers = headers if headers is not None else {}
+    self.body = b""
     self.file = file
+    self.etag = None
+    # size of the .gz variant, 0 if there isn't one and None if unknown
+    self.gzip_length = 0
+    # the part of the file to send
+    self.offset = 0
+    self.length = 0
 
-    try:
-      if (os.stat(self.file)[0] & 0x4000) == 0:
-        self.status = 200
+    entry = _manifest_entry(file)
+    if entry is not None:
+      self.status = status
+      self.length = entry["size"]
+      self.etag = '"' + entry["sha256"][:16] + '"'
+      self.gzip_length = entry.get("gzip", 0)
+    else:
+      try:
+        stat = os.stat(self.file)
+        if (stat[0] & 0x4000) == 0:
+          self.status = status
+          self.length = stat[6]
+          self.etag = '"{:x}-{:x}"'.format(stat[8], stat[6])
+          self.gzip_length = None
+          if stat[8]:
+            headers["Last-Modified"] = _http_date(stat[8])
+      except OSError:
+        pass
 
-        # auto set content type
-        extension = self.file.split(".")[-1].lower()
-        if extension in content_type_map:
-          headers["Content-Type"] = content_type_map[extension]
+    if self.etag is not None:
+      # auto set content type
+      extension = self.file.split(".")[-1].lower()
+      if extension in content_type_map:
+        headers["Content-Type"] = content_type_map[extension]
 
-        headers["Content-Length"] = os.stat(self.file)[6]
-    except OSError:
-      return False
+      headers["Accept-Ranges"] = "bytes"
+      headers["ETag"] = self.etag
+
+    headers["Content-Length"] = self.length
+
+  # switches to the pre-compressed .gz sibling if there is one
+  def _select_gzip(self, accept_encoding):
+    if self.gzip_length is None:
+      try:
+        self.gzip_length = os.stat(self.file + ".gz")[6]
+      except OSError:
+        self.gzip_length = 0
+    if not self.gzip_length:
+      return
+
+    self.headers["Vary"] = "Accept-Encoding"
+    if "gzip" not in accept_encoding:
+      return
+    self.file += ".gz"
+    self.length = self.gzip_length
+    self.etag = self.etag[:-1] + '-gz"'
+    self.headers["ETag"] = self.etag
+    self.headers["Content-Encoding"] = "gzip"
+    self.headers["Content-Length"] = self.length
+
+  # narrows the response for conditional and range requests, answering
+  # with 304 if the client's copy is current and 206 or 416 for ranges.
+  # clients that accept gzip are given the pre-compressed variant
+  def prepare(self, request):
+    if self.status != 200:
+      return
+
+    self._select_gzip(request.headers.get("accept-encoding", ""))
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+      not_modified = if_none_match.strip() == "*" or self.etag in if_none_match
+    else:
+      last_modified = self.headers.get("Last-Modified")
+      not_modified = last_modified is not None and request.headers.get("if-modified-since") == last_modified
+    if not_modified:
+      self.status = 304
+      self.length = 0
+      del self.headers["Content-Length"]
+      return
+
+    range_header = request.headers.get("range")
+    if range_header is None:
+      return
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range != self.etag:
+      return
+
+    size = self.length
+    byte_range = _parse_range(range_header, size)
+    if byte_range is None:
+      return
+    if byte_range is False:
+      self.status = 416
+      self.length = 0
+      self.headers["Content-Range"] = f"bytes */{size}"
+      self.headers["Content-Length"] = 0
+      return
+
+    start, end = byte_range
+    self.status = 206
+    self.offset = start
+    self.length = end - start + 1
+    self.headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    self.headers["Content-Length"] = self.length
+
+
+# responses are assembled in a buffer of _write_buffer_size bytes, about
+# one tcp segment, and handed to the stream a buffer at a time. the status
+# line, headers and the start of the body share the first write, and
+# small template fragments are gathered up instead of being written and
+# drained one by one. a buffer can stay partly filled across a drain, so
+# each response takes its own from a small pool
+_write_buffer_size = 1460
+_write_buffers = []
+
+# the write buffer pool keeps enough for the requests being served and a
+# few more, buffers beyond that are dropped on release so a burst of
+# connections doesn't leave its peak pinned on the heap
+_POOL_MARGIN = 2
+
+
+def _pool_full(pool):
+  return len(pool) >= _max_in_flight + _POOL_MARGIN
+
+# chunks are framed in place around the data, with a fixed width size
+# line ("05b4\r\n", leading zeros are allowed) reserved before the data
+# is known and the trailing crlf and final "0\r\n\r\n" fitting in the
+# spare room at the end of the buffer
+_CHUNK_HEAD = 6
+_BUFFER_SPARE = 8
+
+# status lines are encoded once on first use
+_status_lines = {}
+
+
+def _status_line(status):
+  line = _status_lines.get(status)
+  if line is None:
+    line = "HTTP/1.1 {} {}\r\n".format(status, status_message_map.get(status, "Unknown")).encode("ascii")
+    if status in status_message_map:
+      _status_lines[status] = line
+  return line
+
+
+class _ResponseWriter:
+  def __init__(self, writer, chunked=False):
+    self.writer = writer
+    self.buffer = _write_buffers.pop() if _write_buffers else bytearray(_write_buffer_size + _BUFFER_SPARE)
+    self.view = memoryview(self.buffer)
+    self.fill = 0
+    self.chunked = chunked
+    # where the size line of the chunk being filled starts
+    self.chunk_start = None
+
+  def _append(self, data):
+    end = self.fill + len(data)
+    if end > len(self.buffer):
+      # only very long headers get here, pass on what we have, write()
+      # copies anything the socket doesn't take
+      self.writer.write(self.view[:self.fill])
+      self.fill = 0
+      end = len(data)
+    self.view[self.fill:end] = data
+    self.fill = end
+
+  # status line and headers, these always fit in the empty buffer
+  def head(self, status, headers=None):
+    self._append(_status_line(status))
+    if headers:
+      for key, value in headers.items():
+        self._append(key.encode("ascii"))
+        self._append(b": ")
+        self._append(str(value).encode("ascii"))
+        self._append(b"\r\n")
+    self._append(b"\r\n")
+
+  def _close_chunk(self):
+    length = self.fill - self.chunk_start - _CHUNK_HEAD
+    self.view[self.chunk_start:self.chunk_start + _CHUNK_HEAD] = ("%04x\r\n" % length).encode()
+    self._append(b"\r\n")
+    self.chunk_start = None
+
+  def _end_chunk(self):
+    if self.chunk_start is not None:
+      if self.fill - self.chunk_start > _CHUNK_HEAD:
+        self._close_chunk()
+      else: # nothing in the chunk yet
+        self.fill = self.chunk_start
+        self.chunk_start = None
+
+  # hands what has been gathered to the stream and waits for it to drain
+  async def flush(self):
+    self._end_chunk()
+    if self.fill:
+      self.writer.write(self.view[:self.fill])
+      self.fill = 0
+      await self.writer.drain()
+
+  # returns a view of the free space in the buffer for the next part of
+  # the body, flushing first if there is too little
+  async def _space(self):
+    if self.fill >= _write_buffer_size - _CHUNK_HEAD:
+      await self.flush()
+    if self.chunked and self.chunk_start is None:
+      self.chunk_start = self.fill
+      self.fill += _CHUNK_HEAD
+    return self.view[self.fill:_write_buffer_size]
+
+  async def write(self, data):
+    if isinstance(data, str):
+      data = data.encode("utf-8")
+    data = memoryview(data)
+    position = 0
+    while position < len(data):
+      space = await self._space()
+      count = min(len(data) - position, len(space))
+      space[:count] = data[position:position + count]
+      self.fill += count
+      position += count
+
+  # reads length bytes of a file straight into the buffer
+  async def write_file(self, path, offset, length):
+    with open(path, "rb") as f:
+      if offset:
+        f.seek(offset)
+      while length > 0:
+        space = await self._space()
+        count = f.readinto(space if length >= len(space) else space[:length])
+        if not count:
+          break
+        self.fill += count
+        length -= count
+
+  # sends anything left and ends a chunked body, the terminator goes out
+  # in the same write as the last chunk
+  async def finish(self):
+    if self.chunked:
+      self._end_chunk()
+      self._append(b"0\r\n\r\n")
+    await self.flush()
+
+  # returns the buffer to the pool, the writer can't be used after this
+  def release(self):
+    if self.buffer is not None:
+      if not _pool_full(_write_buffers):
+        _write_buffers.append(self.buffer)
+      self.buffer = self.view = None
+
+
+# strips any trailing slash so "/settings" and "/settings/" share a
+# single route, the root path is left as it is
+def _normalise_path(path):
+  if len(path) > 1 and path[-1] == "/":
+    path = path.rstrip("/") or "/"
+  return path
 
 
 class Route:
-  def __init__(self, path, handler, methods=["GET"]):
+  def __init__(self, path, handler, methods=["GET"], upload=None):
     self.path = path
     self.methods = methods
     self.handler = handler
-    self.path_parts = path.split("/")
+    # optional factory for the sinks that receive uploaded file parts
+    self.upload = upload
+    self.path_parts = _normalise_path(path).split("/")
+    self.parameter_names = [
+      part[1:-1] for part in self.path_parts if part.startswith("<")
+    ]
 
-  # returns True if the supplied request matches this route
-  def matches(self, request):
-    if request.method not in self.methods:
-      return False
-    compare_parts = request.path.split("/")
-    if len(compare_parts) != len(self.path_parts):
-      return False
-    for part, compare in zip(self.path_parts, compare_parts):
-      if not part.startswith("<") and part != compare:
-        return False
-    return True
-
-  # call the route handler passing any named parameters in the path
-  def call_handler(self, request):
+  # call the route handler passing any named parameters in the path,
+  # values are either supplied by the dispatcher or pulled from the path
+  def call_handler(self, request, values=None):
+    if values is None:
+      values = [
+        compare for part, compare in zip(self.path_parts, _normalise_path(request.path).split("/"))
+        if part.startswith("<")
+      ]
     parameters = {}
-    for part, compare in zip(self.path_parts, request.path.split("/")):
-      if part.startswith("<"):
-        name = part[1:-1]
-        parameters[name] = compare
+    for name, value in zip(self.parameter_names, values):
+      parameters[name] = value
 
     return self.handler(request, **parameters)
         
@@ -149,63 +540,478 @@ methods: {self.methods}
     return f"<Route object {self.path} ({', '.join(self.methods)})>"
 
 
-# parses the headers for a http request (or the headers attached to
-# each field in a multipart/form-data)
+# a node in the parameter route trie, literal segments are children
+# keyed by name and a <param> segment is the single param child
+class _RouteNode:
+  def __init__(self):
+    self.children = {}
+    self.param = None
+    self.routes = None
+
+
+# request lines and headers are read through a fixed buffer per
+# connection. a line that doesn't fit in the buffer is refused with 414
+# (request line) or 431 (header), as are requests with more than
+# _max_headers headers or _max_header_bytes of them in total
+_header_buffer_size = 1024
+_max_headers = 32
+_max_header_bytes = 4096
+# there are never more read buffers than the requests that can be served
+# or queued and a few more, see _read_budget(). connections beyond that
+# are refused before taking one, and the pool keeps them all so once it
+# has filled no connection allocates
+_read_buffers = []
+_read_buffers_out = 0
+
+
+def _read_budget():
+  return _max_in_flight + _max_queued + _POOL_MARGIN
+
+# the only request headers anything here looks at, the rest are skipped
+# without being decoded. add to it with keep_header() if a handler needs
+# another one
+_kept_headers = {
+  "content-length", "content-type", "connection", "accept-encoding",
+  "if-none-match", "if-modified-since", "if-range", "range",
+}
+_kept_header_lengths = {len(name) for name in _kept_headers}
+
+
+def set_header_limits(buffer_size=1024, max_headers=32, max_header_bytes=4096):
+  global _header_buffer_size, _max_headers, _max_header_bytes
+  _header_buffer_size = buffer_size
+  _max_headers = max_headers
+  _max_header_bytes = max_header_bytes
+  _read_buffers.clear()
+
+
+def keep_header(name):
+  _kept_headers.add(name.lower())
+  _kept_header_lengths.add(len(name))
+
+
+# raised when a request goes over the limits, answered with status
+class _RequestTooLarge(Exception):
+  def __init__(self, status):
+    super().__init__(status)
+    self.status = status
+
+
+# wraps a connection's stream with the fixed header buffer, whatever has
+# been read past the headers is handed out first by the body methods
+class _RequestReader:
+  def __init__(self, reader):
+    global _read_buffers_out
+    self.reader = reader
+    self.buffer = _read_buffers.pop() if _read_buffers else bytearray(_header_buffer_size)
+    _read_buffers_out += 1
+    self.view = memoryview(self.buffer)
+    self.start = 0
+    self.end = 0
+    # lines are found in an immutable copy of the buffered bytes, taken
+    # once per read rather than once per line
+    self.data = None
+    self.data_start = 0
+
+  async def _fill(self):
+    if self.start == self.end:
+      self.start = self.end = 0
+    elif self.start:
+      # move what is left to the front
+      self.buffer[:self.end - self.start] = self.buffer[self.start:self.end]
+      self.end -= self.start
+      self.start = 0
+    count = await self.reader.readinto(self.view[self.end:])
+    if count:
+      self.end += count
+      self.data = bytes(self.view[:self.end])
+      self.data_start = 0
+    return count
+
+  # returns (data, start, end) locating the next line in data without the
+  # line ending, or None at the end of the stream
+  async def next_line(self, status=431):
+    while True:
+      if self.data is not None:
+        offset = self.start - self.data_start
+        index = self.data.find(b"\n", offset, self.end - self.data_start)
+        if index != -1:
+          self.start = self.data_start + index + 1
+          end = index - 1 if index > offset and self.data[index - 1] == 13 else index
+          return self.data, offset, end
+      if self.start == 0 and self.end == len(self.buffer):
+        raise _RequestTooLarge(status)
+      if not await self._fill():
+        return None
+
+  async def readline(self):
+    line = await self.next_line(414)
+    if line is None:
+      return None
+    data, start, end = line
+    return data[start:end]
+
+  def _buffered(self, size):
+    count = min(self.end - self.start, size)
+    start = self.start
+    self.start += count
+    return self.view[start:start + count]
+
+  async def readinto(self, buf):
+    if self.start < self.end:
+      count = min(self.end - self.start, len(buf))
+      buf[:count] = self._buffered(count)
+      return count
+    return await self.reader.readinto(buf)
+
+  async def read(self, size):
+    if self.start < self.end:
+      return bytes(self._buffered(size))
+    return await self.reader.read(size)
+
+  async def readexactly(self, size):
+    data = b""
+    while len(data) < size:
+      chunk = await self.read(size - len(data))
+      if not chunk:
+        raise EOFError("connection closed")
+      data += chunk
+    return data
+
+  def release(self):
+    global _read_buffers_out
+    if self.buffer is not None:
+      _read_buffers_out -= 1
+      if len(self.buffer) == _header_buffer_size and len(_read_buffers) < _read_budget():
+        _read_buffers.append(self.buffer)
+    self.buffer = self.view = self.data = None
+
+
+# parses the headers for a http request from a _RequestReader, keeping
+# only _kept_headers (the headers of each multipart/form-data part go
+# through _parse_part_headers instead)
 async def _parse_headers(reader):
   headers = {}
+  count = 0
+  total = 0
   while True:
-    header_line = await reader.readline()
-    if header_line == b"\r\n": # crlf denotes body start
+    line = await reader.next_line()
+    if line is None:
+      raise ValueError("connection closed in the headers")
+    data, start, end = line
+    if start == end: # crlf denotes body start
       break
-    name, value = header_line.decode().strip().split(": ", 1)
-    headers[name.lower()] = value
+    count += 1
+    total += end - start
+    if count > _max_headers or total > _max_header_bytes:
+      raise _RequestTooLarge(431)
+    colon = data.find(b":", start, end)
+    # headers we don't use (or can't parse) are skipped on the length of
+    # their name alone, nearly all of them without decoding anything
+    if colon == -1 or colon - start not in _kept_header_lengths:
+      continue
+    name = data[start:colon].decode().lower()
+    if name in _kept_headers:
+      headers[name] = data[colon + 1:end].decode().strip()
   return headers
 
 
-# returns the route matching the supplied path or None
-def _match_route(request):
-  for route in _routes:
-    if route.matches(request):
+# walks the trie for the supplied path parts, literal segments are
+# preferred over parameters and parameter values are collected as we go
+def _find_route(node, parts, index, method, values):
+  if index == len(parts):
+    if node.routes is not None:
+      return node.routes.get(method)
+    return None
+
+  part = parts[index]
+  child = node.children.get(part)
+  if child is not None:
+    route = _find_route(child, parts, index + 1, method, values)
+    if route is not None:
       return route
+
+  if node.param is not None:
+    values.append(part)
+    route = _find_route(node.param, parts, index + 1, method, values)
+    if route is not None:
+      return route
+    values.pop()
+
   return None
 
 
-# if the content type is multipart/form-data then parse the fields
-async def _parse_form_data(reader, headers):
-  boundary = headers["content-type"].split("boundary=")[1]
-  # discard first boundary line
-  dummy = await reader.readline()
+# returns the route matching the supplied request and the values of any
+# path parameters, or (None, None)
+def _match_route(request):
+  path = _normalise_path(request.path)
+  routes = _static_routes.get(path)
+  if routes is not None:
+    route = routes.get(request.method)
+    if route is not None:
+      return route, []
+
+  if _param_routes is not None:
+    values = []
+    route = _find_route(_param_routes, path.split("/"), 0, request.method, values)
+    if route is not None:
+      return route, values
+
+  return None, None
+
+
+# multipart bodies are parsed through a fixed buffer, it must hold the
+# headers of any one part. field values over _max_field_size bytes are
+# refused with 400 and file parts are streamed to an upload sink, by default a
+# temporary file in upload_dir, so they are never held in ram
+_form_buffer_size = 1024
+_max_field_size = 1024
+upload_dir = "tmp"
+_upload_count = 0
+
+
+# a file part that was streamed to flash, the file is removed once the
+# response has been sent unless the handler moves it somewhere else
+class UploadedFile:
+  def __init__(self, filename, content_type, path):
+    self.filename = filename
+    self.content_type = content_type
+    self.path = path
+    self.size = 0
+
+  def __repr__(self):
+    return f"<UploadedFile {self.filename} ({self.size} bytes)>"
+
+
+# upload sinks receive a part's body through write() and return the value
+# to store in request.form from close(), abort() is called instead of
+# close() if the body is cut short
+class _TempFileSink:
+  def __init__(self, request, name, filename, content_type):
+    global _upload_count
+    _upload_count += 1
+    try:
+      os.mkdir(upload_dir)
+    except OSError:
+      pass
+    self.upload = UploadedFile(filename, content_type, f"{upload_dir}/upload{_upload_count}")
+    self.file = open(self.upload.path, "wb")
+    request.uploads.append(self.upload.path)
+
+  def write(self, data):
+    self.file.write(data)
+    self.upload.size += len(data)
+
+  def close(self):
+    self.file.close()
+    return self.upload
+
+  def abort(self):
+    self.file.close()
+
+
+class _FieldSink:
+  def __init__(self):
+    self.value = bytearray()
+
+  def write(self, data):
+    if len(self.value) + len(data) > _max_field_size:
+      raise ValueError("form field too large")
+    self.value.extend(data)
+
+  def close(self):
+    return str(self.value, "utf-8")
+
+  def abort(self):
+    pass
+
+
+class _DiscardSink:
+  def write(self, data):
+    pass
+
+
+class _MultipartParser:
+  def __init__(self, reader, boundary, content_length):
+    self.reader = reader
+    self.delimiter = b"\r\n--" + boundary.encode()
+    self.buffer = bytearray(_form_buffer_size)
+    self.view = memoryview(self.buffer)
+    self.remaining = content_length
+    # the body starts with a delimiter that has no leading crlf, priming
+    # the buffer with one lets the preamble be skipped like any part
+    self.buffer[0:2] = b"\r\n"
+    self.start = 0
+    self.end = 2
+
+  # moves unread data to the front of the buffer and reads more of the
+  # body after it, returns False if the buffer is already full
+  async def _fill(self):
+    if self.start:
+      self.buffer[0:self.end - self.start] = self.view[self.start:self.end]
+      self.end -= self.start
+      self.start = 0
+    space = len(self.buffer) - self.end
+    if space == 0:
+      return False
+    if self.remaining == 0:
+      raise ValueError("truncated form data")
+    count = await uasyncio.wait_for(
+      self.reader.readinto(self.view[self.end:self.end + min(space, self.remaining)]), _body_timeout)
+    if not count:
+      raise ValueError("truncated form data")
+    self.end += count
+    self.remaining -= count
+    return True
+
+  # reads the headers of the next part and returns the content-disposition
+  # parameters (name, filename) along with its content-type
+  async def read_headers(self):
+    while True:
+      window = bytes(self.view[self.start:self.end])
+      if window.startswith(b"\r\n"): # a part with no headers
+        self.start += 2
+        return {}
+      index = window.find(b"\r\n\r\n")
+      if index != -1:
+        self.start += index + 4
+        return _parse_part_headers(window[:index])
+      if not await self._fill():
+        raise ValueError("form part headers too large")
+
+  # streams the body of the current part to sink, returns True if another
+  # part follows and False after the closing delimiter
+  async def read_part(self, sink):
+    delimiter = self.delimiter
+    while True:
+      window = bytes(self.view[self.start:self.end])
+      index = window.find(delimiter)
+      if index != -1:
+        if index:
+          sink.write(self.view[self.start:self.start + index])
+        self.start += index + len(delimiter)
+        while self.end - self.start < 2:
+          await self._fill()
+        marker = bytes(self.view[self.start:self.start + 2])
+        self.start += 2
+        if marker == b"--":
+          return False
+        if marker == b"\r\n":
+          return True
+        raise ValueError("bad multipart delimiter")
+
+      # everything that can't be the start of a delimiter can be passed on
+      safe = len(window) - len(delimiter) + 1
+      if safe > 0:
+        sink.write(self.view[self.start:self.start + safe])
+        self.start += safe
+      await self._fill()
+
+  # discards the epilogue so the connection is left at the next request
+  async def finish(self):
+    while self.remaining:
+      self.start = self.end = 0
+      await self._fill()
+
+
+def _parse_part_headers(data):
+  part = {}
+  for line in data.decode().split("\r\n"):
+    name, _, value = line.partition(":")
+    name = name.strip().lower()
+    if name == "content-disposition":
+      for parameter in value.split(";")[1:]:
+        key, _, parameter_value = parameter.strip().partition("=")
+        part[key.lower()] = parameter_value.strip('"')
+    elif name == "content-type":
+      part["content-type"] = value.strip()
+  return part
+
+
+# if the content type is multipart/form-data then parse the fields, file
+# parts are handed to the route's upload sink factory if it has one
+async def _parse_form_data(reader, request, upload=None):
+  headers = request.headers
+  boundary = headers["content-type"].split("boundary=")[1].split(";")[0].strip('"')
+  parser = _MultipartParser(reader, boundary, int(headers["content-length"]))
 
   form = {}
-  while True:
-    # get the field name
-    field_headers = await _parse_headers(reader)
-    if len(field_headers) == 0:
+  more = await parser.read_part(_DiscardSink())
+  while more:
+    part = await parser.read_headers()
+    filename = part.get("filename")
+    if filename is not None:
+      content_type = part.get("content-type", "application/octet-stream")
+      sink = (upload or _TempFileSink)(request, part.get("name"), filename, content_type)
+    else:
+      sink = _FieldSink()
+    try:
+      more = await parser.read_part(sink)
+    except:
+      sink.abort()
+      raise
+    form[part.get("name")] = sink.close()
+  await parser.finish()
+  return form
+
+
+# if the content type is application/x-www-form-urlencoded then parse the body
+async def _parse_urlencoded_body(reader, headers):
+  content_length = int(headers["content-length"])
+  form_data = bytearray(content_length)
+  view = memoryview(form_data)
+  received = 0
+  while received < content_length:
+    count = await reader.readinto(view[received:])
+    if not count:
       break
-    name = field_headers["content-disposition"].split("name=\"")[1][:-1]
-    # get the field value
-    value = ""
-    while True:
-      line = await reader.readline()
-      line = line.decode().strip()
-      # if we hit a boundary then save the value and move to next field
-      if line == "--" + boundary:
-        form[name] = value
-        break
-      # if we hit end of form data boundary then save value and return
-      if line == "--" + boundary + "--":
-        form[name] = value
-        return form
-      value += line
-  return None
+    received += count
+  return _parse_query_string(bytes(view[:received]))
+
 
+# removes any temporary upload files the handler left behind
+def _remove_uploads(request):
+  for path in request.uploads:
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+  request.uploads = []
 
-# if the content type is application/json then parse the body
+
+# if the content type is application/json then parse the body. a body
+# that isn't valid json gives None, it has been read so the handler can
+# still answer (and the connection be reused)
 async def _parse_json_body(reader, headers):
   import json
   content_length_bytes = int(headers["content-length"])
   body = await reader.readexactly(content_length_bytes)
-  return json.loads(body.decode())
+  try:
+    return json.loads(body.decode())
+  except ValueError:
+    return None
+
+
+# reads the request body into request.form or request.data, returns False
+# if the body was left unread in the stream. small bodies must arrive
+# within _body_timeout, multipart bodies (which may be large uploads)
+# must instead keep arriving with no gap longer than that
+async def _parse_body(reader, request, upload=None):
+  if "content-length" not in request.headers:
+    return True
+
+  content_type = request.headers.get("content-type", "")
+  if content_type.startswith("multipart/form-data"):
+    request.form = await _parse_form_data(reader, request, upload)
+  elif content_type.startswith("application/json"):
+    request.data = await uasyncio.wait_for(_parse_json_body(reader, request.headers), _body_timeout)
+  elif content_type.startswith("application/x-www-form-urlencoded"):
+    request.form = await uasyncio.wait_for(_parse_urlencoded_body(reader, request.headers), _body_timeout)
+  elif int(request.headers["content-length"]) > 0:
+    # we don't know where an unparsed body ends up in the stream so
+    # the connection can't carry another request
+    return False
+  return True
 
 
 status_message_map = {
@@ -220,46 +1026,245 @@ status_message_map = {
   408: "Request Timeout", 409: "Conflict", 410: "Gone",
   414: "URI Too Long", 415: "Unsupported Media Type", 
   416: "Range Not Satisfiable", 418: "I'm a teapot",
-  500: "Internal Server Error", 501: "Not Implemented"
+  431: "Request Header Fields Too Large",
+  500: "Internal Server Error", 501: "Not Implemented",
+  503: "Service Unavailable"
+}
+
+
+# persistent connection limits. a connection is closed once it has been
+# idle for _keep_alive_timeout seconds or has served
+# _keep_alive_max_requests requests, and connections opened while more
+# than _max_connections are open are served a single request and closed
+# so that lwip pcbs are handed back quickly
+_keep_alive_timeout = 5
+_keep_alive_max_requests = 20
+_max_connections = 4
+_open_connections = 0
+
+
+def set_keep_alive(timeout=5, max_requests=20, max_connections=4):
+  global _keep_alive_timeout, _keep_alive_max_requests, _max_connections
+  _keep_alive_timeout = timeout
+  _keep_alive_max_requests = max_requests
+  _max_connections = max_connections
+
+
+# admission control. at most _max_in_flight requests are processed at
+# once, up to _max_queued more wait for a slot and anything beyond that
+# is refused with a 503. the header and body read phases are bounded by
+# their own timeouts so a slow client can't hold on to a slot (or heap)
+_max_in_flight = 2
+_max_queued = 4
+_header_timeout = 5
+_body_timeout = 10
+
+counters = {
+  "accepted": 0,
+  "queued": 0,
+  "rejected": 0,
+  "timed_out": 0,
 }
 
 
-# handle an incoming request to the web server
+def set_limits(max_in_flight=2, max_queued=4, header_timeout=5, body_timeout=10):
+  global _max_in_flight, _max_queued, _header_timeout, _body_timeout
+  _max_in_flight = max_in_flight
+  _max_queued = max_queued
+  _header_timeout = header_timeout
+  _body_timeout = body_timeout
+
+
+# a counting semaphore with a bounded wait queue, uasyncio doesn't ship
+# one. a released slot is handed straight to the oldest waiter
+class _Admission:
+  def __init__(self):
+    self.in_flight = 0
+    self.waiters = []
+
+  # returns True once a slot is held, False if the queue is full
+  async def acquire(self):
+    if self.in_flight < _max_in_flight:
+      self.in_flight += 1
+      counters["accepted"] += 1
+      return True
+    if len(self.waiters) >= _max_queued:
+      counters["rejected"] += 1
+      return False
+
+    counters["queued"] += 1
+    event = uasyncio.Event()
+    self.waiters.append(event)
+    try:
+      await event.wait()
+    except BaseException:
+      if event in self.waiters:
+        self.waiters.remove(event)
+      else: # the slot was handed to us as we were cancelled
+        self.release()
+      raise
+    counters["accepted"] += 1
+    return True
+
+  def release(self):
+    if self.waiters:
+      self.waiters.pop(0).set()
+    else:
+      self.in_flight -= 1
+
+  # True when a new request would be refused
+  def full(self):
+    return self.in_flight >= _max_in_flight and len(self.waiters) >= _max_queued
+
+
+_admission = _Admission()
+_refused = PrebuiltResponse(503, {"Retry-After": 1})
+
+
+# returns the current counters along with the in flight, queued and open
+# connection gauges
+def get_stats():
+  stats = dict(counters)
+  stats["in_flight"] = _admission.in_flight
+  stats["waiting"] = len(_admission.waiters)
+  stats["open_connections"] = _open_connections
+  return stats
+
+
+# write a bodyless response, used when we refuse or give up on a request
+async def _write_status(writer, status, headers=None):
+  if headers is None:
+    headers = {}
+  headers["Content-Length"] = 0
+  headers["Connection"] = "close"
+  response_writer = _ResponseWriter(writer)
+  try:
+    response_writer.head(status, headers)
+    await response_writer.finish()
+  finally:
+    response_writer.release()
+
+
+# returns True if the client asked for (or defaults to) a persistent
+# connection
+def _wants_keep_alive(request):
+  connection = request.headers.get("connection", "").lower()
+  if request.protocol == "HTTP/1.1":
+    return connection != "close"
+  return connection == "keep-alive"
+
+
+# handle an incoming connection to the web server, requests are served
+# one after another (including any the client has pipelined) until
+# either side asks for the connection to be closed
 async def _handle_request(reader, writer):
-  response = None
+  global _open_connections
+  _open_connections += 1
+  request_reader = None
+  try:
+    # a connection that could only be refused, or that would take a read
+    # buffer beyond the budget, is answered before it takes one so a burst
+    # of them costs no heap
+    if _admission.full() or _read_buffers_out >= _read_budget():
+      counters["rejected"] += 1
+      writer.write(_refused.close)
+      await writer.drain()
+      return
+    request_reader = _RequestReader(reader)
+    served = 0
+    while True:
+      try:
+        request_line = await uasyncio.wait_for(request_reader.readline(), _keep_alive_timeout)
+      except uasyncio.TimeoutError:
+        if served == 0: # connected but never sent a request
+          counters["timed_out"] += 1
+        break
+      except _RequestTooLarge as e:
+        await _write_status(writer, e.status)
+        break
+      if request_line is None: # client closed the connection
+        break
+      if not request_line: # stray blank line between requests
+        continue
+
+      served += 1
+      if not await _admission.acquire():
+        writer.write(_refused.close)
+        await writer.drain()
+        break
+      try:
+        keep_alive = served < _keep_alive_max_requests and _open_connections <= _max_connections
+        if not await _serve_request(request_reader, writer, request_line, keep_alive):
+          break
+      finally:
+        _admission.release()
+  except Exception as e:
+    logging.error("> connection error: %s", e)
+  finally:
+    _open_connections -= 1
+    if request_reader is not None:
+      request_reader.release()
+    writer.close()
+    await writer.wait_closed()
 
+
+# serve a single request, returns True if the connection can be reused
+async def _serve_request(reader, writer, request_line, keep_alive):
   request_start_time = time.ticks_ms()
 
-  request_line = await reader.readline()
   try:
     method, uri, protocol = request_line.decode().split()
   except Exception as e:
     logging.error(e)
-    return
+    return False
 
   request = Request(method, uri, protocol)
-  request.headers = await _parse_headers(reader)
-  if "content-length" in request.headers and "content-type" in request.headers:
-    if request.headers["content-type"].startswith("multipart/form-data"):
-      request.form = await _parse_form_data(reader, request.headers)
-    if request.headers["content-type"].startswith("application/json"):
-      request.data = await _parse_json_body(reader, request.headers)
-    if request.headers["content-type"].startswith("application/x-www-form-urlencoded"):
-      form_data = b""
-      content_length = int(request.headers["content-length"])
-      while content_length > 0:
-        data = await reader.read(content_length)
-        if len(data) == 0:
-          break
-        content_length -= len(data)
-        form_data += data
-      request.form = _parse_query_string(form_data.decode()) 
+  route, values = _match_route(request)
+  try:
+    request.headers = await uasyncio.wait_for(_parse_headers(reader), _header_timeout)
+    keep_alive = keep_alive and _wants_keep_alive(request)
+    if not await _parse_body(reader, request, route.upload if route else None):
+      keep_alive = False
+  except uasyncio.TimeoutError:
+    counters["timed_out"] += 1
+    logging.info("> %s %s timed out reading request", request.method, request.path)
+    _remove_uploads(request)
+    await _write_status(writer, 408)
+    return False
+  except _RequestTooLarge as e:
+    logging.info("> %s %s headers too large", request.method, request.path)
+    _remove_uploads(request)
+    await _write_status(writer, e.status)
+    return False
+  except ValueError as e:
+    logging.info("> %s %s bad request: %s", request.method, request.path, e)
+    _remove_uploads(request)
+    await _write_status(writer, 400)
+    return False
 
-  route = _match_route(request)
+  # uploads are removed however the handler or the response ends
+  try:
+    return await _send_response(writer, request, route, values, keep_alive, request_start_time)
+  finally:
+    _remove_uploads(request)
+
+
+# runs the handler and writes its response, returns True if the
+# connection can be reused
+async def _send_response(writer, request, route, values, keep_alive, request_start_time):
+  response = None
   if route:
-    response = route.call_handler(request)
+    response = route.call_handler(request, values)
   elif catchall_handler:
     response = catchall_handler(request)
+  if response is None:
+    response = Response("", status=404)
+
+  if isinstance(response, PrebuiltResponse):
+    writer.write(response.keep_alive if keep_alive else response.close)
+    await writer.drain()
+    logging.info("> %s %s (%d) [%dms]", request.method, request.path, response.status, time.ticks_ms() - request_start_time)
+    return keep_alive
 
   # if shorthand body generator only notation used then convert to tuple
   if type(response).__name__ == "generator":
@@ -278,50 +1283,79 @@ async def _handle_request(reader, writer):
     response.add_header("Content-Type", content_type)
     if hasattr(body, '__len__'):
       response.add_header("Content-Length", len(body))
-  
-  # write status line
-  status_message = status_message_map.get(response.status, "Unknown")
-  writer.write(f"HTTP/1.1 {response.status} {status_message}\r\n".encode("ascii"))
 
-  # write headers
-  for key, value in response.headers.items():
-    writer.write(f"{key}: {value}\r\n".encode("ascii"))
-
-  # blank line to denote end of headers
-  writer.write("\r\n".encode("ascii"))
- 
   if isinstance(response, FileResponse):
-    # file
-    with open(response.file, "rb") as f:
-      while True:
-        chunk = f.read(1024)
-        if not chunk:
-          break
-        writer.write(chunk)
-        await writer.drain()
-  elif type(response.body).__name__ == "generator":
-    # generator
-    for chunk in response.body:
-      writer.write(chunk)
-      await writer.drain()
-  else:
-    # string/bytes
-    writer.write(response.body)
-    await writer.drain()
-  
-  writer.close()
-  await writer.wait_closed()
+    response.prepare(request)
+
+  # the client can only find the end of the body if we tell it the length
+  # or, for generators, send it in chunks
+  chunked = False
+  if not isinstance(response, FileResponse) and "Content-Length" not in response.headers:
+    if hasattr(response.body, '__len__'):
+      response.add_header("Content-Length", len(response.body))
+    elif request.protocol == "HTTP/1.1":
+      response.add_header("Transfer-Encoding", "chunked")
+      chunked = True
+    else:
+      keep_alive = False
+  response.add_header("Connection", "keep-alive" if keep_alive else "close")
   
+  # status line, headers and the body all go through one buffer
+  response_writer = _ResponseWriter(writer, chunked)
+  try:
+    response_writer.head(response.status, response.headers)
+    if isinstance(response, FileResponse):
+      # file
+      if response.length:
+        await response_writer.write_file(response.file, response.offset, response.length)
+    elif type(response.body).__name__ == "generator":
+      # generator
+      for chunk in response.body:
+        await response_writer.write(chunk)
+    elif response.body:
+      # string/bytes
+      await response_writer.write(response.body)
+    await response_writer.finish()
+  finally:
+    response_writer.release()
+
   processing_time = time.ticks_ms() - request_start_time
-  logging.info(f"> {request.method} {request.path} ({response.status} {status_message}) [{processing_time}ms]")
+  logging.info("> %s %s (%d) [%dms]", request.method, request.path, response.status, processing_time)
+  return keep_alive
+
 
+# adds a new route to the routing table, the first route registered for
+# a given path and method wins
+def add_route(path, handler, methods=["GET"], upload=None):
+  global _param_routes
+  route = Route(path, handler, methods, upload)
+
+  if route.parameter_names:
+    if _param_routes is None:
+      _param_routes = _RouteNode()
+    node = _param_routes
+    for part in route.path_parts:
+      if part.startswith("<"):
+        if node.param is None:
+          node.param = _RouteNode()
+        node = node.param
+      else:
+        child = node.children.get(part)
+        if child is None:
+          child = node.children[part] = _RouteNode()
+        node = child
+    if node.routes is None:
+      node.routes = {}
+    routes = node.routes
+  else:
+    path = _normalise_path(path)
+    routes = _static_routes.get(path)
+    if routes is None:
+      routes = _static_routes[path] = {}
 
-# adds a new route to the routing table
-def add_route(path, handler, methods=["GET"]):
-  global _routes
-  _routes.append(Route(path, handler, methods))
-  # descending complexity order so most complex routes matched first
-  _routes = sorted(_routes, key=lambda route: len(route.path_parts), reverse=True)
+  for method in methods:
+    if method not in routes:
+      routes[method] = route
 
 
 def set_callback(handler):
@@ -330,9 +1364,9 @@ def set_callback(handler):
 
 
 # decorator shorthand for adding a route
-def route(path, methods=["GET"]):
+def route(path, methods=["GET"], upload=None):
   def _route(f):
-    add_route(path, f, methods=methods)
+    add_route(path, f, methods=methods, upload=upload)
     return f
   return _route
 
@@ -354,7 +1388,7 @@ def serve_file(file):
 
 
 def run(host = "0.0.0.0", port = 80):
-  logging.info("> starting web server on port {}".format(port))
+  logging.info("> starting web server on port %d", port)
   loop.create_task(uasyncio.start_server(_handle_request, host, port))
   loop.run_forever()
 
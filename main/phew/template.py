@@ -1,66 +1,149 @@
+import os
 import logging
 
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ucollections import OrderedDict
 
-async def render_template(template, **kwargs):
-  import time
-  start_time = time.ticks_ms()
+# compiled templates are cached in a small lru keyed by path, each entry
+# remembers the mtime of the file it was compiled from so an edited
+# template is recompiled on its next render
+_cache_size = 12
+_cache = OrderedDict()
+
+
+def set_cache_size(size):
+  global _cache_size
+  _cache_size = size
+  while len(_cache) > _cache_size:
+    del _cache[next(iter(_cache))]
+
+
+def clear_cache():
+  _cache.clear()
+
+
+# compile a single tag expression, names are kept alongside the code so
+# that plain variable references can be looked up and escaped without
+# going through eval at all
+def _compile_expression(expression, template):
+  source = expression.decode("utf-8")
+  try:
+    code = compile(source, template, "eval")
+  except NameError: # firmware built without the compile() builtin
+    code = source
+  name = source if _is_name(source) else None
+  return (name, code)
 
+
+def _is_name(source):
+  if not source or not (source[0].isalpha() or source[0] == "_"):
+    return False
+  for c in source:
+    if not (c.isalpha() or c.isdigit() or c == "_"):
+      return False
+  return True
+
+
+# turns a template into a list of literal byte chunks and compiled
+# (name, code) expression tuples
+def _compile(template):
   with open(template, "rb") as f:
     # read the whole template file, we could work on single lines but
     # the performance is much worse - so long as our content are
     # just a handful of kB it's ok to do this
     data = f.read()
-    token_caret = 0
-
-    while True:
-      # find the next tag that needs evaluating
-      start = data.find(b"{{", token_caret)
-      end = data.find(b"}}", start)
-
-      match = start != -1 and end != -1
-
-      # no more magic to handle, just return what's left
-      if not match:
-        yield data[token_caret:]
-        break
-
-      expression = data[start + 2:end].strip()
-
-      # output the bit before the tag
-      yield data[token_caret:start]
-
-      # merge locals with the supplied named arguments and
-      # the response object
-      params = {}
-      params.update(locals())
-      params.update(kwargs)
-      #params["response"] = response
-
-      # parse the expression
-      try:
-        if expression.decode("utf-8") in params:
-          result = params[expression.decode("utf-8")]
-          result = result.replace("&", "&amp;")
-          result = result.replace('"', "&quot;")
-          result = result.replace("'", "&apos;")
-          result = result.replace(">", "&gt;")
-          result = result.replace("<", "&lt;")
-        else:
-          result = eval(expression, globals(), params)
-
-        if type(result).__name__ == "generator":
-          # if expression returned a generator then iterate it fully
-          # and yield each result
-          for chunk in result:
-            yield chunk
-        else:
-          # yield the result of the expression
-          if result is not None:
-            yield str(result)
-      except:
-        pass
-
-      # discard the parsed bit
-      token_caret = end + 2
-
-  logging.debug("> parsed template:", template, "(took", time.ticks_ms() - start_time, "ms)")
\ No newline at end of file
+
+  parts = []
+  token_caret = 0
+  while True:
+    # find the next tag that needs evaluating
+    start = data.find(b"{{", token_caret)
+    end = data.find(b"}}", start)
+
+    # no more magic to handle, just keep what's left
+    if start == -1 or end == -1:
+      if token_caret < len(data):
+        parts.append(data[token_caret:])
+      break
+
+    # keep the bit before the tag
+    if start > token_caret:
+      parts.append(data[token_caret:start])
+
+    expression = data[start + 2:end].strip()
+    try:
+      parts.append(_compile_expression(expression, template))
+    except Exception as e:
+      # a broken tag renders as nothing, same as a failing expression
+      logging.error("> template", template, "bad expression", expression, e)
+
+    # discard the parsed bit
+    token_caret = end + 2
+
+  return parts
+
+
+# returns the compiled form of a template, from the cache if the file
+# has not changed since it was compiled
+def _load(template):
+  mtime = os.stat(template)[8]
+  entry = _cache.get(template)
+  if entry is not None:
+    # re-insert to mark as most recently used
+    del _cache[template]
+    if entry[0] == mtime:
+      _cache[template] = entry
+      return entry[1]
+
+  parts = _compile(template)
+  if _cache_size > 0:
+    _cache[template] = (mtime, parts)
+    while len(_cache) > _cache_size:
+      del _cache[next(iter(_cache))]
+  return parts
+
+
+def _escape(result):
+  result = result.replace("&", "&amp;")
+  result = result.replace('"', "&quot;")
+  result = result.replace("'", "&apos;")
+  result = result.replace(">", "&gt;")
+  result = result.replace("<", "&lt;")
+  return result
+
+
+async def render_template(template, **kwargs):
+  import time
+  timed = logging.is_enabled(logging.LOG_DEBUG)
+  if timed:
+    start_time = time.ticks_ms()
+
+  for part in _load(template):
+    if isinstance(part, bytes):
+      yield part
+      continue
+
+    name, code = part
+    # parse the expression
+    try:
+      if name is not None and name in kwargs:
+        result = _escape(kwargs[name])
+      else:
+        result = eval(code, globals(), kwargs)
+
+      if type(result).__name__ == "generator":
+        # if expression returned a generator then iterate it fully
+        # and yield each result
+        for chunk in result:
+          yield chunk
+      else:
+        # yield the result of the expression
+        if result is not None:
+          yield str(result)
+    except:
+      pass
+
+  if timed:
+    logging.debug("> parsed template: %s (took %d ms)", template, time.ticks_diff(time.ticks_ms(), start_time))
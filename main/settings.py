@@ -4,6 +4,9 @@ from phew.template import render_template
 
 APP_NAME = "Pi Pico Embedded"
 AP_DOMAIN = "pipico.net"
+# names the access point's dns server resolves for real (through the
+# station connection, when there is one) instead of pointing them at us
+DNS_PASSTHROUGH = ()
 
 SETTINGS_TEMPLATE_PATH = "content/settings"
 CONTENT_PATH = "content"
@@ -24,22 +27,19 @@ async def home(request):
 #     return Template('page2.html').render(args)
 
 @server.route("/settings", methods=["GET"])
-@server.route("/settings/", methods=["GET"])
 async def settings_home(request):
     logging.debug("settings_home")
     args = get_args(page='Settings')
     return await render_template(f"{SETTINGS_TEMPLATE_PATH}/home.html", args=args)
 
 
-# return file in IMAGES_PATH
+# return file in IMAGES_PATH, streamed by the server with caching and
+# range support
 @server.route("/static/<file_name>", methods=['GET', 'POST'])
-async def static(request, file_name):
+def static(request, file_name):
     file_path = f"{IMAGES_PATH}/{file_name}"
-    logging.debug('getting static content ' + file_path)
-    page = open(file_path, "rb")
-    content = page.read()
-    page.close()
-    return content, 200
+    logging.debug('getting static content %s', file_path)
+    return server.serve_file(file_path)
 
 
 # catchall example
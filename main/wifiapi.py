@@ -0,0 +1,181 @@
+import json
+
+import logging
+from phew import server
+from wificonfig import WIFI_MAX_SSIDS, check_network
+from wifimanager import wifi_manager
+
+# json versions of the wi-fi settings pages for scripts provisioning
+# devices from a host. bodies are written a piece at a time as they are
+# encoded, nothing goes through the template engine and scans are only
+# done when asked for with ?refresh=1. changes to the saved networks are
+# kept in memory until /api/wifi/save, as on the settings pages
+#
+#   GET  /api/wifi/status
+#   GET  /api/wifi/scan[?refresh=1]
+#   GET  /api/wifi/networks
+#   POST /api/wifi/networks/add      {"ssid": ..., "password": ...}
+#   POST /api/wifi/networks/remove   {"ssid": ...} or {"index": ...}
+#   POST /api/wifi/networks/reorder  {"ssids": [...]} or {"index": ..., "to": ...}
+#   POST /api/wifi/save
+
+
+class ApiError(Exception):
+    pass
+
+
+# encodes value a container element at a time so large lists never need
+# the whole document in memory
+def _encode(value):
+    if isinstance(value, dict):
+        separator = "{"
+        for key, item in value.items():
+            yield separator + json.dumps(str(key)) + ":"
+            yield from _encode(item)
+            separator = ","
+        yield "}" if separator == "," else "{}"
+    elif isinstance(value, (list, tuple)):
+        separator = "["
+        for item in value:
+            yield separator
+            yield from _encode(item)
+            separator = ","
+        yield "]" if separator == "," else "[]"
+    else:
+        yield json.dumps(value)
+
+
+def _reply(value, status=200):
+    return _encode(value), status, "application/json"
+
+
+# wraps a handler so ApiError comes back as a json 400 rather than a page
+def _api(handler):
+    def wrapper(request):
+        try:
+            if request.data is None:
+                raise ApiError('invalid json')
+            return _reply(handler(request))
+        except ApiError as e:
+            logging.info('api %s: %s', request.path, e)
+            return _reply({'error': str(e)}, 400)
+    return wrapper
+
+
+def _field(data, name, kind):
+    if not isinstance(data, dict) or name not in data:
+        raise ApiError('missing ' + name)
+    value = data[name]
+    if not isinstance(value, kind) or isinstance(value, bool):
+        raise ApiError('invalid ' + name)
+    return value
+
+
+# the index of a saved network given by "ssid" or "index"
+def _network_index(data):
+    if isinstance(data, dict) and 'ssid' in data:
+        ssid = _field(data, 'ssid', str)
+        for index, credentials in enumerate(wifi_manager.ssids):
+            if credentials[0] == ssid:
+                return index
+        raise ApiError('unknown ssid ' + ssid)
+    index = _field(data, 'index', int)
+    if index < 0 or index >= len(wifi_manager.ssids):
+        raise ApiError('index out of range')
+    return index
+
+
+# the saved networks in priority order, passwords are never returned
+def _networks():
+    return {'networks': [credentials[0] for credentials in wifi_manager.ssids],
+            'max': WIFI_MAX_SSIDS}
+
+
+def wifi_status(request):
+    sta_connected = wifi_manager.sta.isconnected()
+    return {'sta': {'connected': sta_connected,
+                    'ssid': wifi_manager.sta.config('ssid') if sta_connected else None,
+                    'ifconfig': wifi_manager.sta.ifconfig()},
+            'ap': {'ssid': wifi_manager.config.hostname,
+                   'active': wifi_manager.ap.active(),
+                   'connected': wifi_manager.ap.isconnected(),
+                   'runwap': wifi_manager.config.runwap},
+            'stats': wifi_manager.get_stats()}
+
+
+def wifi_scan(request):
+    if 'refresh' in request.query:
+        waps = wifi_manager.scan_for_waps_sorted()
+    else:
+        waps = wifi_manager.cached_waps()
+    return {'age': wifi_manager.waps_age(),
+            'networks': [{'ssid': ssid, 'rssi': rssi} for ssid, rssi in waps]}
+
+
+def wifi_networks(request):
+    return _networks()
+
+
+# adding a network that is already saved replaces its password and moves
+# it to the top, so provisioning scripts can be run more than once
+def wifi_add(request):
+    ssid = _field(request.data, 'ssid', str)
+    password = _field(request.data, 'password', str)
+    try:
+        check_network(ssid, password)
+    except ValueError as e:
+        raise ApiError(str(e))
+    for index, credentials in enumerate(wifi_manager.ssids):
+        if credentials[0] == ssid:
+            wifi_manager.remove_ssid(index)
+            break
+    logging.debug('api add_ssid %s', ssid)
+    wifi_manager.insert_ssid(ssid, password)
+    return _networks()
+
+
+def wifi_remove(request):
+    index = _network_index(request.data)
+    logging.debug('api remove_ssid %d', index)
+    wifi_manager.remove_ssid(index)
+    return _networks()
+
+
+# either the complete new order by ssid (any saved networks left out keep
+# their order after the listed ones) or a single move of index to "to"
+def wifi_reorder(request):
+    data = request.data
+    if isinstance(data, dict) and 'ssids' in data:
+        order = _field(data, 'ssids', list)
+        saved = [credentials[0] for credentials in wifi_manager.ssids]
+        for ssid in order:
+            if ssid not in saved:
+                raise ApiError('unknown ssid ' + str(ssid))
+        ranked = [credentials for credentials in wifi_manager.ssids if credentials[0] in order]
+        ranked.sort(key=lambda credentials: order.index(credentials[0]))
+        ranked.extend(credentials for credentials in wifi_manager.ssids if credentials[0] not in order)
+        wifi_manager.config.networks = ranked
+    else:
+        index = _network_index(data)
+        to = _field(data, 'to', int)
+        if to < 0 or to >= len(wifi_manager.ssids):
+            raise ApiError('to out of range')
+        wifi_manager.move_ssid_to(index, to)
+    return _networks()
+
+
+# writes straight away rather than after the usual delay, a script may
+# power the device off as soon as it has its answer
+def wifi_save(request):
+    wifi_manager.save()
+    wifi_manager.config.flush()
+    return {'saved': wifi_manager.config.is_saved()}
+
+
+server.add_route("/api/wifi/status", _api(wifi_status), methods=["GET"])
+server.add_route("/api/wifi/scan", _api(wifi_scan), methods=["GET"])
+server.add_route("/api/wifi/networks", _api(wifi_networks), methods=["GET"])
+server.add_route("/api/wifi/networks/add", _api(wifi_add), methods=["POST"])
+server.add_route("/api/wifi/networks/remove", _api(wifi_remove), methods=["POST"])
+server.add_route("/api/wifi/networks/reorder", _api(wifi_reorder), methods=["POST"])
+server.add_route("/api/wifi/save", _api(wifi_save), methods=["POST"])
@@ -0,0 +1,220 @@
+import json
+import os
+import uasyncio as asyncio
+
+import logging
+
+# the wi-fi settings are kept in a small binary file, written whole to a
+# temporary file and renamed over the old one so a power cut never leaves
+# a half written config. saves are coalesced by run_flusher() and skipped
+# if nothing has changed since the last write
+WIFI_CONFIG_FILE = "config/wifi.bin"
+# a wifi.json found in config is imported and renamed to wifi.json.bak,
+# copy a new one in to replace the settings
+WIFI_LEGACY_FILE = "config/wifi.json"
+WIFI_MAX_SSIDS = 5
+# longest ssid the radio takes, and the wpa passphrase limits (an empty
+# password is an open network)
+WIFI_MAX_SSID_BYTES = 32
+WIFI_MIN_PASSWORD_BYTES = 8
+WIFI_MAX_PASSWORD_BYTES = 63
+# saves are written this long after the first request, catching any
+# further changes made in the meantime
+WIFI_FLUSH_DELAY_MS = 2000
+
+RUNWAP_CHOICES = ("always", "as needed", "never")
+
+_MAGIC = b"WC"
+_VERSION = 1
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _append_string(data, value):
+    encoded = value.encode("utf-8")
+    if len(encoded) > 255:
+        raise ValueError("too long: " + value)
+    data.append(len(encoded))
+    data.extend(encoded)
+
+
+# raises ValueError for credentials that could never be used to connect
+def check_network(ssid, password):
+    ssid_length = len(ssid.encode("utf-8"))
+    if not ssid_length or ssid_length > WIFI_MAX_SSID_BYTES:
+        raise ValueError("ssid must be 1 to %d bytes" % WIFI_MAX_SSID_BYTES)
+    password_length = len(password.encode("utf-8"))
+    if password_length and not WIFI_MIN_PASSWORD_BYTES <= password_length <= WIFI_MAX_PASSWORD_BYTES:
+        raise ValueError("password must be empty or %d to %d bytes" %
+                         (WIFI_MIN_PASSWORD_BYTES, WIFI_MAX_PASSWORD_BYTES))
+
+
+class WiFiConfig:
+    def __init__(self, filename=WIFI_CONFIG_FILE, legacy_filename=WIFI_LEGACY_FILE):
+        self.filename = filename
+        self.legacy_filename = legacy_filename
+        self.save_requested = False
+        self.flush_wakeup = asyncio.Event()
+        # the bytes last read or written, to skip saves that change nothing
+        self.saved = None
+        self.defaults()
+
+    def defaults(self):
+        self.hostname = "pi_pico_w"
+        self.ap_password = "p1c0wifi"
+        self.runwap = "always"
+        # None for dhcp, "cached" or [ip, netmask, gateway, dns]
+        self.static_ip = None
+        # (ssid, password) in the order they are tried, highest priority first
+        self.networks = []
+
+    def load(self):
+        logging.debug('loading %s', self.filename)
+        if _exists(self.legacy_filename):
+            self.migrate()
+            return
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            self.decode(data)
+            self.saved = data
+        except (OSError, ValueError, IndexError) as e:
+            logging.error('could not load %s (%s), using defaults', self.filename, e)
+            self.defaults()
+            self.save_requested = True
+            self.flush()
+
+    # imports the settings from the old json file
+    def migrate(self):
+        logging.info('migrating %s to %s', self.legacy_filename, self.filename)
+        self.defaults()
+        try:
+            with open(self.legacy_filename) as f:
+                attributes = json.load(f)
+            self.hostname = str(attributes.get('HOSTNAME', self.hostname))
+            self.ap_password = str(attributes.get('PASSWORD', self.ap_password))
+            if attributes.get('RUNWAP') in RUNWAP_CHOICES:
+                self.runwap = attributes['RUNWAP']
+            static_ip = attributes.get('STATIC_IP')
+            if isinstance(static_ip, list):
+                static_ip = [str(part) for part in static_ip]
+            self.static_ip = static_ip
+            # entries were [index, ssid, password] with the index as a string
+            wifi = sorted(attributes.get('WIFI', []), key=lambda x: x[0])
+            for entry in wifi:
+                try:
+                    check_network(str(entry[1]), str(entry[2]))
+                except ValueError as e:
+                    logging.error('skipping %s: %s', entry[1], e)
+                    continue
+                self.networks.append((str(entry[1]), str(entry[2])))
+            self.networks = self.networks[:WIFI_MAX_SSIDS]
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            logging.error('could not read %s: %s', self.legacy_filename, e)
+        self.save_requested = True
+        self.flush()
+        if self.is_saved():
+            os.rename(self.legacy_filename, self.legacy_filename + '.bak')
+
+    def encode(self):
+        data = bytearray(_MAGIC)
+        data.append(_VERSION)
+        _append_string(data, self.hostname)
+        _append_string(data, self.ap_password)
+        data.append(RUNWAP_CHOICES.index(self.runwap))
+        if isinstance(self.static_ip, (list, tuple)):
+            _append_string(data, ','.join(self.static_ip))
+        else:
+            _append_string(data, self.static_ip or '')
+        data.append(len(self.networks))
+        for ssid, password in self.networks:
+            _append_string(data, ssid)
+            _append_string(data, password)
+        return bytes(data)
+
+    def decode(self, data):
+        if data[:2] != _MAGIC or data[2] != _VERSION:
+            raise ValueError('not a wi-fi config')
+        view = memoryview(data)
+        position = 3
+
+        def read_string():
+            nonlocal position
+            length = data[position]
+            value = str(view[position + 1:position + 1 + length], 'utf-8')
+            position += 1 + length
+            return value
+
+        hostname = read_string()
+        ap_password = read_string()
+        runwap = RUNWAP_CHOICES[data[position]]
+        position += 1
+        static_ip = read_string()
+        count = data[position]
+        position += 1
+        networks = []
+        for _ in range(count):
+            ssid = read_string()
+            networks.append((ssid, read_string()))
+
+        self.hostname = hostname
+        self.ap_password = ap_password
+        self.runwap = runwap
+        if not static_ip:
+            self.static_ip = None
+        elif static_ip == 'cached':
+            self.static_ip = static_ip
+        else:
+            self.static_ip = static_ip.split(',')
+        self.networks = networks
+
+    # asks for the settings to be written, run_flusher() does it shortly
+    def save(self):
+        self.save_requested = True
+        self.flush_wakeup.set()
+
+    # True if the file holds the current settings
+    def is_saved(self):
+        try:
+            return self.saved == self.encode()
+        except (ValueError, TypeError):
+            return False
+
+    # writes the settings now if a save was asked for and they have changed,
+    # returns True if the file was written. settings that can't be encoded
+    # are logged and left unsaved, this must never stop run_flusher()
+    def flush(self):
+        if not self.save_requested:
+            return False
+        self.save_requested = False
+        try:
+            data = self.encode()
+        except (ValueError, TypeError) as e:
+            logging.error('could not save %s: %s', self.filename, e)
+            return False
+        if data == self.saved:
+            logging.debug('%s unchanged, not saving', self.filename)
+            return False
+        try:
+            with open(self.filename + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            logging.error('could not save %s: %s', self.filename, e)
+            return False
+        self.saved = data
+        logging.debug('saved %s', self.filename)
+        return True
+
+    async def run_flusher(self):
+        while True:
+            await self.flush_wakeup.wait()
+            await asyncio.sleep_ms(WIFI_FLUSH_DELAY_MS)
+            self.flush_wakeup.clear()
+            self.flush()
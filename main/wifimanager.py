@@ -1,23 +1,98 @@
 import json
 import network
+import os
+import random
+import struct
+import time
 import uasyncio as asyncio
 
 import logging
 
-from phew import server
+from phew import dns, server
 from phew.template import render_template
 
-from settings import SETTINGS_TEMPLATE_PATH, APP_NAME
+from settings import SETTINGS_TEMPLATE_PATH, APP_NAME, DNS_PASSTHROUGH
+from wificonfig import WiFiConfig, WIFI_CONFIG_FILE, WIFI_MAX_SSIDS, RUNWAP_CHOICES, check_network
 
-WIFI_FILE = "config/wifi.json"
 WIFI_MAX_ATTEMPTS = 3
-WIFI_MAX_SSIDS = 5
+# per ssid connection history, {ssid: [successes, failures, average ms]}
+WIFI_HISTORY_FILE = "config/wifi_history.json"
+WIFI_CONNECT_TIMEOUT_MS = 10000
+# the network joined last time, tried first without a scan, see
+# read_fast_record()
+WIFI_FAST_FILE = "config/wifi_fast.bin"
+WIFI_FAST_TIMEOUT_MS = 5000
+# seconds between background scans, more often while the settings pages
+# have been used in the last WIFI_UI_ACTIVE_MS
+WIFI_SCAN_INTERVAL = 300
+WIFI_SCAN_INTERVAL_ACTIVE = 20
+WIFI_UI_ACTIVE_MS = 120000
+# the supervisor checks the link this often, and once it is lost retries
+# with a delay doubling from WIFI_BACKOFF_MIN to WIFI_BACKOFF_MAX seconds,
+# each randomised by +-25% so a room full of devices doesn't retry in step
+WIFI_CHECK_INTERVAL_MS = 2000
+WIFI_BACKOFF_MIN = 2
+WIFI_BACKOFF_MAX = 300
+
+# magic, version, bssid, channel, ip, netmask, gateway, dns, ssid length,
+# followed by the ssid
+_FAST_FORMAT = "<2sB6sB4s4s4s4sB"
+_FAST_MAGIC = b"WF"
+_FAST_VERSION = 1
+
+# statuses that mean waiting any longer for the connection is pointless
+_FAILED_STATUSES = (network.STAT_WRONG_PASSWORD, network.STAT_NO_AP_FOUND, network.STAT_CONNECT_FAIL)
+
+def _pack_ip(address):
+    return bytes(int(part) for part in address.split('.'))
+
+
+def _unpack_ip(packed):
+    return '.'.join(str(part) for part in packed)
+
+
+# returns (ssid, bssid, channel, ifconfig) for the last good connection
+# or None
+def read_fast_record():
+    try:
+        with open(WIFI_FAST_FILE, 'rb') as f:
+            data = f.read()
+        header_size = struct.calcsize(_FAST_FORMAT)
+        magic, version, bssid, channel, ip, netmask, gateway, dns, ssid_length = \
+            struct.unpack(_FAST_FORMAT, data[:header_size])
+        if magic != _FAST_MAGIC or version != _FAST_VERSION:
+            return None
+        ssid = str(data[header_size:header_size + ssid_length], 'utf-8')
+        ifconfig = (_unpack_ip(ip), _unpack_ip(netmask), _unpack_ip(gateway), _unpack_ip(dns))
+        return (ssid, bssid, channel, ifconfig)
+    except (OSError, ValueError):
+        return None
+
+
+def write_fast_record(record):
+    ssid, bssid, channel, ifconfig = record
+    ssid = ssid.encode('utf-8')
+    ip, netmask, gateway, dns = [_pack_ip(address) for address in ifconfig]
+    data = struct.pack(_FAST_FORMAT, _FAST_MAGIC, _FAST_VERSION, bssid, channel,
+                       ip, netmask, gateway, dns, len(ssid)) + ssid
+    try:
+        with open(WIFI_FAST_FILE + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(WIFI_FAST_FILE + '.tmp', WIFI_FAST_FILE)
+    except OSError as e:
+        logging.error('could not save %s: %s', WIFI_FAST_FILE, e)
+
+
+def remove_fast_record():
+    try:
+        os.remove(WIFI_FAST_FILE)
+    except OSError:
+        pass
+
 
 class WiFiManager:
-    def __init__(self, wlan_filename=WIFI_FILE):
-        self.wlan_filename = wlan_filename
-        self.wlan_attributes = None
-        self.ssids = None
+    def __init__(self, wlan_filename=WIFI_CONFIG_FILE):
+        self.config = WiFiConfig(wlan_filename)
         self.sta = network.WLAN(network.STA_IF)
         self.sta.disconnect()
         self.sta.active(False)
@@ -25,41 +100,99 @@ class WiFiManager:
         self.ap = network.WLAN(network.AP_IF)
         self.ap.disconnect()
         self.ap.active(False)
+        self.history = {}
+        self.history_dirty = False
+        # set whenever sta_connecting changes so the ap follows promptly
+        self.link_changed = asyncio.Event()
+        # connection metrics, see get_stats()
+        self.counters = {'disconnects': 0, 'reconnects': 0, 'failed_attempts': 0}
+        self.connected_ticks = None
+        self.connected_ms = 0
+        # the last scan, (ssid, rssi) sorted strongest first
+        self.waps = []
+        self.waps_ticks = None
+        # {ssid: (bssid, channel)} of the strongest access point last scan
+        self.bssids = {}
+        self.static_ip = False
+        self.ui_ticks = None
+        self.scan_wakeup = asyncio.Event()
+        self.dns_started = False
         self.load()
-        if 'HOSTNAME' in self.wlan_attributes:
-            network.hostname(str(self.wlan_attributes['HOSTNAME']))
+        self.load_history()
+        network.hostname(self.config.hostname)
+
+    # the saved (ssid, password) pairs, highest priority first
+    @property
+    def ssids(self):
+        return self.config.networks
 
     def load(self):
         logging.debug('load')
-        try:
-            logging.debug('opening ' + self.wlan_filename)
-            with open(self.wlan_filename) as f:
-                self.wlan_attributes = json.load(f)
-            f.close()
-            logging.debug('opened ' + self.wlan_filename)
-        except OSError:  # open failed
-            logging.debug('open failed for ' + self.wlan_filename)
-            # handle the file open case
-            self.wlan_attributes = {
-                'WIFI': [],
-                "HOSTNAME": "pi_pico_w",
-                "PASSWORD": "p1c0wifi",
-                "RUNWAP": "always",
-                "RUNWAP_CHOICES": ["always", "as needed", "never"]
-            }
-            # save the current version
-            with open(self.wlan_filename, 'w') as f:
-                json.dump(self.wlan_attributes, f)
-        self.ssids = list(self.wlan_attributes['WIFI'])
-        self.ssids.sort(key=lambda x: x[0])
+        # a save still waiting to be written is kept
+        self.config.flush()
+        self.config.load()
         logging.debug('load done')
 
     def save(self):
         logging.debug('save')
-        self.update_ssid_order()
-        self.wlan_attributes['WIFI'] = self.ssids
-        with open(self.wlan_filename, 'w') as f:
-            json.dump(self.wlan_attributes, f)
+        self.config.save()
+
+    def load_history(self):
+        try:
+            with open(WIFI_HISTORY_FILE) as f:
+                self.history = json.load(f)
+        except (OSError, ValueError):
+            self.history = {}
+
+    def save_history(self):
+        if not self.history_dirty:
+            return
+        self.history_dirty = False
+        # only keep the history of ssids that are still saved
+        saved = [credentials[0] for credentials in self.ssids]
+        self.history = {ssid: entry for ssid, entry in self.history.items() if ssid in saved}
+        try:
+            with open(WIFI_HISTORY_FILE, 'w') as f:
+                json.dump(self.history, f)
+        except OSError as e:
+            logging.error('could not save %s: %s', WIFI_HISTORY_FILE, e)
+
+    def record_attempt(self, ssid, connected, elapsed_ms):
+        entry = self.history.get(ssid, [0, 0, 0])
+        if connected:
+            # running average of the time it takes to connect
+            entry[2] = (entry[2] * entry[0] + elapsed_ms) // (entry[0] + 1)
+            entry[0] += 1
+        else:
+            entry[1] += 1
+        self.history[ssid] = entry
+        self.history_dirty = True
+
+    # higher is better: the signal strength in dBm, plus up to 20 for a
+    # record of connecting successfully, less a point per second it
+    # usually takes to connect
+    def rank(self, ssid, rssi):
+        successes, failures, average_ms = self.history.get(ssid, (0, 0, 0))
+        return rssi + 20 * (successes + 1) // (successes + failures + 2) - average_ms // 1000
+
+    # the saved credentials that are visible in a single scan, best first.
+    # networks the scan doesn't see are skipped rather than each costing a
+    # connect timeout, so a hidden network is only tried when the scan
+    # finds nothing at all and the saved order is kept
+    def connection_candidates(self):
+        try:
+            visible = dict(self.scan_for_waps_sorted())
+        except OSError as e:
+            logging.error('scan failed: %s', e)
+            visible = {}
+        if not visible:
+            return list(self.ssids)
+        candidates = [credentials for credentials in self.ssids if credentials[0] in visible]
+        for credentials in self.ssids:
+            if credentials[0] not in visible:
+                logging.debug('%s not visible, skipping', credentials[0])
+        candidates.sort(reverse=True, key=lambda c: self.rank(c[0], visible[c[0]]))
+        return candidates
 
     async def setup_connection(self):
         logging.debug('connect()')
@@ -67,33 +200,179 @@ class WiFiManager:
         connected = False
         if self.sta.isconnected():
             logging.info('Connected: %s', self.sta.ifconfig())
+            self.set_connecting(True)
+            self.mark_connected()
             return True
-        self.sta_connecting = True
+        self.set_connecting(True)
+        record = read_fast_record()
+        ssid = await self.fast_connect(record)
+        if ssid is None:
+            self.apply_ip_config()
+            for credentials in self.connection_candidates():
+                if await self.connect_to(credentials[0], credentials[1]):
+                    ssid = credentials[0]
+                    break
+                logging.info('Failed to connect to %s', credentials[0])
+        connected = ssid is not None
+        if connected:
+            logging.info('Connected to %s %s', ssid, self.sta.ifconfig())
+            log_serverUrl()
+            self.save_fast_record(ssid, record)
+            self.mark_connected()
+        else:
+            logging.debug('No Wi-FI connection made')
+        # left set while connected so "as needed" keeps the ap down
+        self.set_connecting(connected)
+        self.save_history()
+        return connected
+
+    def password_for(self, ssid):
         for credentials in self.ssids:
-            ssid = credentials[1]
-            password = credentials[2]
-            connected = await self.connect_to(ssid, password)
+            if credentials[0] == ssid:
+                return credentials[1]
+        return None
+
+    # tries the access point from the last good connection directly,
+    # skipping the scan. returns the ssid if connected
+    async def fast_connect(self, record):
+        if record is None:
+            return None
+        ssid, bssid, channel, ifconfig = record
+        password = self.password_for(ssid)
+        if password is None:
+            return None
+        logging.debug('fast connect to %s on channel %d', ssid, channel)
+        self.apply_ip_config(ifconfig)
+        if await self.connect_to(ssid, password, WIFI_FAST_TIMEOUT_MS, bssid):
+            return ssid
+        # the access point has moved or gone, do it the slow way from now on
+        remove_fast_record()
+        return None
+
+    # a STATIC_IP of [ip, netmask, gateway, dns] in the config skips dhcp,
+    # "cached" reuses the lease from the last connection on a fast connect
+    def apply_ip_config(self, cached=None):
+        static = self.config.static_ip
+        if static == 'cached':
+            static = cached
+        if static:
+            self.sta.ifconfig(tuple(static))
+            self.static_ip = True
+        elif self.static_ip:
+            self.sta.ifconfig('dhcp')
+            self.static_ip = False
+
+    # remembers where we connected for the next boot, only writing to
+    # flash if something has changed
+    def save_fast_record(self, ssid, previous):
+        if ssid in self.bssids:
+            bssid, channel = self.bssids[ssid]
+        elif previous is not None and previous[0] == ssid:
+            bssid, channel = previous[1], previous[2]
+        else:
+            return
+        record = (ssid, bssid, channel, tuple(self.sta.ifconfig()))
+        if record != previous:
+            write_fast_record(record)
+
+    def set_connecting(self, connecting):
+        if connecting != self.sta_connecting:
+            self.sta_connecting = connecting
+            self.link_changed.set()
+
+    def link_up(self):
+        return self.sta.isconnected() and self.sta.status() == network.STAT_GOT_IP
+
+    def mark_connected(self):
+        if self.connected_ticks is None:
+            self.connected_ticks = time.ticks_ms()
+
+    def mark_disconnected(self):
+        if self.connected_ticks is not None:
+            self.connected_ms += time.ticks_diff(time.ticks_ms(), self.connected_ticks)
+            self.connected_ticks = None
+        self.counters['disconnects'] += 1
+        self.sta.disconnect()
+        # lets the "as needed" ap come up while we wait to reconnect
+        self.set_connecting(False)
+
+    # seconds the current connection has been up, 0 if not connected
+    def uptime(self):
+        if self.connected_ticks is None:
+            return 0
+        return time.ticks_diff(time.ticks_ms(), self.connected_ticks) // 1000
+
+    def get_stats(self):
+        stats = dict(self.counters)
+        stats['connected'] = self.connected_ticks is not None
+        stats['uptime'] = self.uptime()
+        stats['connected_time'] = self.connected_ms // 1000 + stats['uptime']
+        return stats
+
+    # backoff seconds as milliseconds, jittered by up to 25% either way
+    def backoff_delay(self, backoff):
+        delay = backoff * 1000
+        return delay - delay // 4 + random.getrandbits(32) % (delay // 2 + 1)
+
+    # in "as needed" mode the ap goes down while we try to connect, so
+    # don't pull it from under someone who is using it
+    def ap_in_use(self):
+        return (self.config.runwap == 'as needed' and
+                self.ap.active() and self.ap.isconnected())
+
+    # connects at boot, then watches the link and reconnects whenever it
+    # is lost, backing off while no saved network can be joined
+    async def run_supervisor(self):
+        logging.debug('run_supervisor')
+        connected = await self.setup_connection()
+        backoff = WIFI_BACKOFF_MIN
+        while True:
             if connected:
-                logging.info('Connected to %s %s', ssid, self.sta.ifconfig())
-                log_serverUrl()
-                return connected
+                await asyncio.sleep_ms(WIFI_CHECK_INTERVAL_MS)
+                if self.link_up():
+                    continue
+                logging.info('Wi-Fi link lost, status %d', self.sta.status())
+                self.mark_disconnected()
+                backoff = WIFI_BACKOFF_MIN
             else:
-                logging.info('Failed to connect to ' + ssid)
-        logging.debug('No Wi-FI connection made')
-        self.sta_connecting = False
-        return connected
-
-    async def connect_to(self, ssid, password):
-        logging.debug('Trying to connect to %s...' % ssid)
-        self.sta.connect(ssid, password)
-        for retry in range(100):
-            connected = self.sta.isconnected()
+                delay = self.backoff_delay(backoff)
+                logging.debug('next Wi-Fi connection attempt in %d ms', delay)
+                await asyncio.sleep_ms(delay)
+                backoff = min(backoff * 2, WIFI_BACKOFF_MAX)
+                if not self.ssids or self.ap_in_use():
+                    continue
+            connected = await self.setup_connection()
             if connected:
-                print()
-                return connected
-            await asyncio.sleep(0.1)
-            print('.', end='')
-        print()
+                self.counters['reconnects'] += 1
+                logging.info('Wi-Fi reconnected, %s', self.get_stats())
+            else:
+                self.counters['failed_attempts'] += 1
+
+    async def connect_to(self, ssid, password, timeout_ms=WIFI_CONNECT_TIMEOUT_MS, bssid=None):
+        logging.debug('Trying to connect to %s...', ssid)
+        start = time.ticks_ms()
+        if bssid is None:
+            self.sta.connect(ssid, password)
+        else:
+            self.sta.connect(ssid, password, bssid=bssid)
+        connected = False
+        while True:
+            elapsed = time.ticks_diff(time.ticks_ms(), start)
+            if self.sta.isconnected():
+                connected = True
+                break
+            status = self.sta.status()
+            if status in _FAILED_STATUSES:
+                # wrong password or no access point, no point waiting
+                logging.debug('connecting to %s failed with status %d', ssid, status)
+                break
+            if elapsed >= timeout_ms:
+                break
+            await asyncio.sleep_ms(100)
+        if not connected:
+            self.sta.disconnect()
+        self.record_attempt(ssid, connected, elapsed)
+        return connected
 
     def scan_for_waps(self):
         logging.debug('Scanning for Wi-Fi networks')
@@ -103,40 +382,92 @@ class WiFiManager:
     def get_host(self):
         return self.sta.ifconfig()[0]
 
+    # the resolver handed out with our lease, None while not connected
+    def dns_server(self):
+        if not self.sta.isconnected():
+            return None
+        return self.sta.ifconfig()[3]
+
+    # scans now and updates the cached results
     def scan_for_waps_sorted(self):
         visible_ssids = self.scan_for_waps()
         visible_ssids.sort(reverse=True, key=lambda x: x[3])
         wap_list = []
         ssid_list = []
+        bssids = {}
         for visible_ssid in visible_ssids:
             ssid_name = str(visible_ssid[0], 'utf-8')
             ssid_signal = visible_ssid[3]
-            if ssid_name is not '' and ssid_name not in ssid_list:  # hidden
+            if ssid_name != '' and ssid_name not in ssid_list:  # hidden
                 ssid_list.append(ssid_name)
                 wap_list.append((ssid_name, ssid_signal))
+                bssids[ssid_name] = (bytes(visible_ssid[1]), visible_ssid[2])
+        self.waps = wap_list
+        self.bssids = bssids
+        self.waps_ticks = time.ticks_ms()
         return wap_list
 
+    def ui_active(self):
+        return (self.ui_ticks is not None and
+                time.ticks_diff(time.ticks_ms(), self.ui_ticks) < WIFI_UI_ACTIVE_MS)
+
+    # the cached scan results for the settings pages, never scans itself.
+    # if the results are older than the settings pages want the
+    # background scan is woken early
+    def cached_waps(self):
+        was_active = self.ui_active()
+        self.ui_ticks = time.ticks_ms()
+        if not was_active and (self.waps_ticks is None or
+                time.ticks_diff(self.ui_ticks, self.waps_ticks) >= WIFI_SCAN_INTERVAL_ACTIVE * 1000):
+            self.scan_wakeup.set()
+        return self.waps
+
+    # seconds since the cached results were scanned, None if never
+    def waps_age(self):
+        if self.waps_ticks is None:
+            return None
+        return time.ticks_diff(time.ticks_ms(), self.waps_ticks) // 1000
+
+    async def run_scan_loop(self):
+        logging.debug('run_scan_loop')
+        while True:
+            interval = WIFI_SCAN_INTERVAL_ACTIVE if self.ui_active() else WIFI_SCAN_INTERVAL
+            try:
+                await asyncio.wait_for(self.scan_wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self.scan_wakeup.clear()
+            # a scan would disturb a connection being made
+            if not self.sta.active() or self.sta.status() == network.STAT_CONNECTING:
+                continue
+            try:
+                self.scan_for_waps_sorted()
+            except OSError as e:
+                logging.error('background scan failed: %s', e)
+
+    # the mutators raise ValueError for credentials that can't be saved
     def insert_ssid(self, new_ssid, new_password):
-        self.ssids.insert(0, ['0', new_ssid, new_password])
-        self.update_ssid_order()
+        check_network(new_ssid, new_password)
+        self.ssids.insert(0, (new_ssid, new_password))
         if len(self.ssids) > WIFI_MAX_SSIDS:
             logging.debug('too many ssids - pop the last')
-            wifi_manager.ssids.pop(WIFI_MAX_SSIDS)
+            self.ssids.pop(WIFI_MAX_SSIDS)
 
+    def remove_ssid(self, index):
+        self.ssids.pop(index)
 
-    def update_ssid_order(self):
-        for i, ssid in enumerate(self.ssids):
-            self.ssids[i][0] = str(i)
+    def set_password(self, index, new_password):
+        check_network(self.ssids[index][0], new_password)
+        self.ssids[index] = (self.ssids[index][0], new_password)
 
     def move_ssid_to(self, index, new_index):
         if (index < 0 or
                 new_index < 0 or
-                index > len(self.ssids) or
-                new_index > len(self.ssids)):
+                index >= len(self.ssids) or
+                new_index >= len(self.ssids)):
             return
         this_ssid = self.ssids.pop(index)
         self.ssids.insert(new_index, this_ssid)
-        self.update_ssid_order()
 
     async def run_wap_loop(self):
         logging.debug('run_wap_loop')
@@ -145,29 +476,38 @@ class WiFiManager:
                 self.ap.active(False)
             else:
                 await self.start_ap()
-            await asyncio.sleep(4)
+            try:
+                await asyncio.wait_for(self.link_changed.wait(), 4)
+            except asyncio.TimeoutError:
+                pass
+            self.link_changed.clear()
 
     async def start_ap(self):
         # ap is required
         if self.ap.active():
             return
-        ssid = wifi_manager.wlan_attributes['HOSTNAME']
-        password = wifi_manager.wlan_attributes['PASSWORD']
+        ssid = self.config.hostname
+        password = self.config.ap_password
         self.ap.config(essid=ssid, password=password)
         self.ap.active(True)
         while not self.ap.active():
             await asyncio.sleep_ms(10)
             print('.', end='')
         print()
-        logging.info('AP active - SSID:' + ssid + ' password:' + password + ' IP:' + str(self.ap.ifconfig()[0]))
+        logging.info('AP active - SSID:%s password:%s IP:%s', ssid, password, self.ap.ifconfig()[0])
+        # the dns server answers with the ap's address, so it can only
+        # start once the ap is up and has one
+        if not self.dns_started:
+            self.dns_started = True
+            dns.run_catchall(self.ap.ifconfig()[0], allowed=DNS_PASSTHROUGH, upstream=self.dns_server)
 
     def ap_required(self):
         # if ap required but not operational start ap
-        if self.wlan_attributes['RUNWAP'] == 'always':
+        if self.config.runwap == 'always':
             return True
         if self.sta_connecting:
             return False
-        if self.wlan_attributes['RUNWAP'] == 'as needed':
+        if self.config.runwap == 'as needed':
             return True
         return False
 
@@ -176,7 +516,6 @@ wifi_manager = WiFiManager()
 
 
 @server.route("/settings/wifi", methods=["GET"])
-@server.route("/settings/wifi/", methods=["GET"])
 async def wifi_home(request):
     logging.debug("wifi_home")
     args = get_args(page='Wi-Fi Settings')
@@ -187,7 +526,7 @@ async def wifi_home(request):
 async def wifi_configure(req):
     logging.debug("/wifi/configure")
     args = get_args(page='Configure Wi-Fi Settings')
-    args['waps'] = wifi_manager.scan_for_waps_sorted()
+    args['waps'] = wifi_manager.cached_waps()
     return await render_template(f"{SETTINGS_TEMPLATE_PATH}/wifi_configure.html", args=args)
 
 
@@ -198,11 +537,14 @@ async def wifi_add_ssid(req):
     action = form['action']
     if 'Add' == action:
         new_ssid = form['ssid']
-        logging.debug('add_ssid ' + new_ssid)
+        logging.debug('add_ssid %s', new_ssid)
         new_password = form['password']
-        wifi_manager.insert_ssid(new_ssid, new_password)
+        try:
+            wifi_manager.insert_ssid(new_ssid, new_password)
+        except ValueError as e:
+            logging.error('add_ssid %s: %s', new_ssid, e)
     args = get_args(page='Added SSID', form=form)
-    args['waps'] = wifi_manager.scan_for_waps_sorted()
+    args['waps'] = wifi_manager.cached_waps()
     return await render_template(f"{SETTINGS_TEMPLATE_PATH}/wifi_configure.html", args=args)
 
 
@@ -214,27 +556,27 @@ async def wifi_update_ssid(req):
     try:
         index = int(ssid_index)
         action = form['action']
-        logging.debug('' + action + ' ' + str(index))
+        logging.debug('%s %d', action, index)
         if 'Remove' == action:
-            logging.debug('update_ssid removing ssid ' + str(index))
-            wifi_manager.ssids.pop(index)
+            logging.debug('update_ssid removing ssid %d', index)
+            wifi_manager.remove_ssid(index)
         if 'v' == action:
-            logging.debug('update_ssid ssid down ' + str(index))
+            logging.debug('update_ssid ssid down %d', index)
             wifi_manager.move_ssid_to(index, index + 1)
         if '^' == action:
-            logging.debug('update_ssid ssid up ' + str(index))
+            logging.debug('update_ssid ssid up %d', index)
             wifi_manager.move_ssid_to(index, index - 1)
         if 'Update' == action:
-            logging.debug('update_ssid password ' + str(index))
+            logging.debug('update_ssid password %d', index)
             new_password = form['password']
-            wifi_manager.ssids[index][2] = new_password
+            wifi_manager.set_password(index, new_password)
 
-    except ValueError:
-        logging.error('update ssid invalid value' + ssid_index)
+    except ValueError as e:
+        logging.error('update ssid %s: %s', ssid_index, e)
     except IndexError:
-        logging.error('update ssid curr_index out of range' + ssid_index)
+        logging.error('update ssid curr_index out of range %s', ssid_index)
     args = get_args(page='Updated SSID settings', form=form)
-    args['waps'] = wifi_manager.scan_for_waps_sorted()
+    args['waps'] = wifi_manager.cached_waps()
     return await render_template(f"{SETTINGS_TEMPLATE_PATH}/wifi_configure.html", args=args)
 
 
@@ -252,9 +594,13 @@ async def wifi_update_config(req):
         logging.debug('update_config Save')
         wifi_manager.save()
         page_name = "Saved Wi-Fi Settings"
+    if 'Refresh' == action:
+        logging.debug('update_config Refresh')
+        wifi_manager.scan_for_waps_sorted()
+        page_name = "Refreshed Visible Networks"
     logging.debug('getting args')
     args = get_args(page=page_name)
-    args['waps'] = wifi_manager.scan_for_waps_sorted()
+    args['waps'] = wifi_manager.cached_waps()
     return await render_template(f"{SETTINGS_TEMPLATE_PATH}/wifi_configure.html", args=args)
 
 
@@ -263,14 +609,14 @@ def log_serverUrl():
     port = 80
     if ssl is None:
         if port == 80:
-            logging.info('http://' + wifi_manager.get_host())
+            logging.info('http://%s', wifi_manager.get_host())
         else:
-            logging.info('http://' + wifi_manager.get_host() + ':' + str(port))
+            logging.info('http://%s:%d', wifi_manager.get_host(), port)
     else:
         if port == 443:
-            logging.info('https://' + wifi_manager.get_host())
+            logging.info('https://%s', wifi_manager.get_host())
         else:
-            logging.info('http://' + wifi_manager.get_host() + ':' + str(port))
+            logging.info('http://%s:%d', wifi_manager.get_host(), port)
 
 
 def get_args(page, form=None):
@@ -278,13 +624,14 @@ def get_args(page, form=None):
     wifi_sta_connected = wifi_manager.sta.isconnected()
     if wifi_sta_connected:
         wifi_sta = wifi_manager.sta.config('ssid')
-    wifi_ap = wifi_manager.wlan_attributes["HOSTNAME"]
-    wifi_ap_password = wifi_manager.wlan_attributes["PASSWORD"]
+    wifi_ap = wifi_manager.config.hostname
+    wifi_ap_password = wifi_manager.config.ap_password
     wifi_ap_connected = wifi_manager.ap.isconnected()
     wifi_ap_up = wifi_manager.ap.active()
 
     ifconfig = wifi_manager.sta.ifconfig()
     ssids = wifi_manager.ssids
+    waps_age = wifi_manager.waps_age()
     args = {'app_name': APP_NAME,
             'page': page,
             'wifi_sta': wifi_sta,
@@ -293,9 +640,13 @@ def get_args(page, form=None):
             'wifi_ap_status' : ['down', 'up'][wifi_ap_up],
             'wifi_ap_password': wifi_ap_password,
             'wifi_ap_connected': wifi_ap_connected,
-            'wifi_ap_required': wifi_manager.wlan_attributes["RUNWAP"],
-            'wifi_ap_choices': wifi_manager.wlan_attributes["RUNWAP_CHOICES"],
+            'wifi_ap_required': wifi_manager.config.runwap,
+            'wifi_ap_choices': RUNWAP_CHOICES,
             'ifconfig': ifconfig,
             'ssids': ssids,
+            'waps_age': waps_age,
+            # shown against the first visible network
+            'waps_label': 'Visible' if waps_age is None else 'Visible ({}s ago)'.format(waps_age),
+            'wifi_stats': wifi_manager.get_stats(),
             'form': form}
     return args
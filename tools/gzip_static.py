@@ -0,0 +1,58 @@
+# host side build step for the static content served by the pico.
+#
+# writes a pre-compressed .gz sibling next to every asset that gets
+# noticeably smaller when gzipped, and a manifest.json with the size and
+# sha256 of each file plus the size of its .gz variant. phew.server reads
+# the manifest so it can serve the assets without any stat calls.
+#
+# run from the repository root before copying main/ to the device:
+#
+#   python tools/gzip_static.py [main/content/static]
+import gzip
+import hashlib
+import json
+import os
+import sys
+
+DEFAULT_STATIC_PATH = os.path.join("main", "content", "static")
+MANIFEST_NAME = "manifest.json"
+
+# only keep a .gz variant if it saves at least this fraction of the file
+MIN_SAVING = 0.1
+
+# extensions that are already compressed and not worth gzipping
+SKIP_EXTENSIONS = (".gz", ".jpg", ".jpeg", ".png", ".gif")
+
+
+def build(static_path=DEFAULT_STATIC_PATH):
+    manifest = {}
+    for name in sorted(os.listdir(static_path)):
+        path = os.path.join(static_path, name)
+        if not os.path.isfile(path) or name == MANIFEST_NAME or name.endswith(".gz"):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        entry = {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+        gz_path = path + ".gz"
+        if not name.lower().endswith(SKIP_EXTENSIONS):
+            # mtime=0 keeps the output identical between builds
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                with open(gz_path, "wb") as f:
+                    f.write(compressed)
+                entry["gzip"] = len(compressed)
+        if "gzip" not in entry and os.path.exists(gz_path):
+            # remove a stale variant so the device never serves it
+            os.remove(gz_path)
+
+        manifest[name] = entry
+        print("{:24} {:>7} {:>7}".format(name, entry["size"], entry.get("gzip", "-")))
+
+    with open(os.path.join(static_path, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, separators=(",", ":"), sort_keys=True)
+    return manifest
+
+
+if __name__ == "__main__":
+    build(*sys.argv[1:2])
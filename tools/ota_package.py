@@ -0,0 +1,145 @@
+# host side packer for over the air updates.
+#
+# builds a tar of the device tree with an ota_manifest.json as its first
+# member, giving the version and the sha256 of every other file. the
+# device verifies each file against the manifest as it is extracted and
+# refuses the update if anything is missing or doesn't match. upload the
+# result on the /settings/firmware/configure page.
+#
+# with --base, given the device's /settings/firmware/manifest (as a url
+# or a saved file), only the files whose hashes differ are packed along
+# with a list of files to delete, and the device applies it on top of
+# the version it has installed.
+#
+# with --index, the package is also recorded in the version.json that the
+# device's pull mode client polls (see tools/ota_server.py), as the full
+# release or, for a delta, as the package for devices on its base version.
+#
+#   python tools/ota_package.py VERSION [-o OUTPUT] [-s SOURCE] [--base MANIFEST] [--index FILE]
+import argparse
+import hashlib
+import io
+import json
+import os
+import tarfile
+import urllib.request
+
+DEFAULT_SOURCE = "main"
+MANIFEST_NAME = "ota_manifest.json"
+
+# device local state that an update must never overwrite
+EXCLUDE = ("config", "ota", "tmp")
+# the device's log segments (log.0, log.1...) and the log.txt of older
+# versions, see LOG_PREFIX in main/ota.py
+LOG_PREFIX = "log."
+
+
+def excluded(path):
+    if "/" not in path and path.startswith(LOG_PREFIX):
+        return True
+    for pattern in EXCLUDE:
+        if path == pattern or path.startswith(pattern + "/"):
+            return True
+    return "__pycache__" in path.split("/") or path.endswith(".pyc")
+
+
+def collect(source):
+    files = {}
+    for root, dirs, names in os.walk(source):
+        dirs.sort()
+        for name in sorted(names):
+            full = os.path.join(root, name)
+            path = os.path.relpath(full, source).replace(os.sep, "/")
+            if path == MANIFEST_NAME or excluded(path):
+                continue
+            with open(full, "rb") as f:
+                files[path] = hashlib.sha256(f.read()).hexdigest()
+    return files
+
+
+def _add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    tar.addfile(info, io.BytesIO(data))
+
+
+def load_base(base):
+    if base.startswith(("http://", "https://")):
+        with urllib.request.urlopen(base) as response:
+            return json.load(response)
+    with open(base) as f:
+        return json.load(f)
+
+
+# the files that differ from the base manifest, the paths it has that we
+# don't and the extra manifest fields a delta carries
+def delta(files, base):
+    base_files = base["files"]
+    changed = {path: digest for path, digest in files.items() if base_files.get(path) != digest}
+    deleted = sorted(path for path in base_files if path not in files and not excluded(path))
+    return changed, {"base": base.get("version", "unknown"), "delete": deleted}
+
+
+def build(version, output, source=DEFAULT_SOURCE, files=None, manifest_extra=None):
+    if files is None:
+        files = collect(source)
+    manifest = {"version": version, "files": files}
+    if manifest_extra:
+        manifest.update(manifest_extra)
+
+    # ustar keeps the headers simple enough for the device to parse
+    with tarfile.open(output, "w", format=tarfile.USTAR_FORMAT) as tar:
+        _add_bytes(tar, MANIFEST_NAME, json.dumps(manifest, sort_keys=True).encode())
+        for path in sorted(files):
+            tar.add(os.path.join(source, path), arcname=path, recursive=False)
+    return manifest
+
+
+def update_index(index_path, output, manifest):
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        index = {}
+    with open(output, "rb") as f:
+        data = f.read()
+    package = {
+        "package": os.path.relpath(output, os.path.dirname(os.path.abspath(index_path))).replace(os.sep, "/"),
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+    if index.get("version") != manifest["version"]:
+        # a new release, deltas to the old one no longer apply
+        index = {"version": manifest["version"], "deltas": {}}
+    if "base" in manifest:
+        index.setdefault("deltas", {})[manifest["base"]] = package
+    else:
+        index.update(package)
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build an over the air update")
+    parser.add_argument("version")
+    parser.add_argument("-o", "--output")
+    parser.add_argument("-s", "--source", default=DEFAULT_SOURCE)
+    parser.add_argument("--base", help="device manifest url or file to build a delta against")
+    parser.add_argument("--index", help="version.json to record the package in")
+    args = parser.parse_args()
+
+    output = args.output or "update-{}.tar".format(args.version)
+    files = collect(args.source)
+    extra = None
+    if args.base:
+        files, extra = delta(files, load_base(args.base))
+    manifest = build(args.version, output, args.source, files, extra)
+    if args.index:
+        update_index(args.index, output, manifest)
+    print("{}: {} files, {} deletions, version {}".format(
+        output, len(manifest["files"]), len(manifest.get("delete", ())), args.version))
+
+
+if __name__ == "__main__":
+    main()
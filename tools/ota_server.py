@@ -0,0 +1,77 @@
+# stand-in update server for testing the device's pull mode ota client.
+#
+# serves a directory holding version.json and the update packages built
+# by tools/ota_package.py --index, with the range request support the
+# device needs to resume an interrupted download. --drop-after N cuts
+# every response off after N bytes to exercise resuming.
+#
+#   python tools/ota_server.py [-d DIRECTORY] [-p PORT] [--drop-after N]
+import argparse
+import functools
+import os
+import re
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    drop_after = None
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else size - 1
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(size))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        end = min(end, size - 1)
+        f = open(path, "rb")
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.range_remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        limit = getattr(self, "range_remaining", None)
+        if self.drop_after is not None:
+            limit = min(limit or self.drop_after, self.drop_after)
+        if limit is None:
+            return super().copyfile(source, outputfile)
+        while limit > 0:
+            chunk = source.read(min(limit, 16 * 1024))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            limit -= len(chunk)
+        if self.drop_after is not None:
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serve ota updates with range support")
+    parser.add_argument("-d", "--directory", default=".")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("--drop-after", type=int, help="cut responses off after this many bytes")
+    args = parser.parse_args()
+
+    RangeRequestHandler.drop_after = args.drop_after
+    handler = functools.partial(RangeRequestHandler, directory=args.directory)
+    server = ThreadingHTTPServer(("", args.port), handler)
+    print("serving {} on port {}".format(os.path.abspath(args.directory), args.port))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()